@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def rss_mb():
+    # current resident set size of this process
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def resident_mb(tensors):
+    # bytes held by the tensors' storages, a storage shared by several tensors (views, stacked weights) counted once
+    storages = {}
+    for t in tensors:
+        storage = t.untyped_storage()
+        storages[(storage.device, storage.data_ptr())] = storage.nbytes()
+    return sum(storages.values()) / 2**20
+
+
+class TimedModel:
+    """Forwards to the model and accumulates the time spent inside forward"""
+
+    def __init__(self, model):
+        self.model = model
+        self.forward_s = 0.0
+
+    def forward(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = self.model.forward(*args, **kwargs)
+        self.forward_s += time.perf_counter() - t0
+        return result
+
+
+def decode_overhead(model, tokens):
+    """
+    Per-token time (us) spent outside model.forward by PIPELINE.generate, by Generator.greedy (no puzzle) and by
+    Generator.generate_ids as minimum_inference.py / demo.py call it (puzzle given, so the trace is checked and the solver
+    trace is the speculative draft; constrained and fast_forward off)
+    """
+    from rwkv.utils import PIPELINE, PIPELINE_ARGS
+    from generation import Generator
+    import puzzle_trace
+    from tools import generate_15_puzzle
+
+    puzzle = generate_15_puzzle(0)
+    ctx = puzzle_trace.format_input(puzzle)
+    result = {}
+
+    timed = TimedModel(model)
+    pipeline = PIPELINE(timed, "rwkv_vocab_v20230424")
+    pipeline.tokenizer = puzzle_trace.get_tokenizer()
+    count = [0]
+
+    def callback(text):
+        count[0] += 1
+
+    t0 = time.perf_counter()
+    pipeline.generate(ctx, token_count=tokens, args=PIPELINE_ARGS(top_k=1, alpha_frequency=0, alpha_presence=0, token_stop=[59]), callback=callback)
+    result["overhead_us_pipeline"] = round((time.perf_counter() - t0 - timed.forward_s) / max(1, count[0]) * 1e6, 1)
+
+    timed = TimedModel(model)
+    generator = Generator(timed)
+    t0 = time.perf_counter()
+    ids = generator.generate_ids(generator.tokenizer.encode(ctx), token_count=tokens)
+    result["overhead_us_greedy"] = round((time.perf_counter() - t0 - timed.forward_s) / max(1, len(ids)) * 1e6, 1)
+
+    for _ in range(2):  # the first run pays one-time setup (solver tables, tokenizer caches), time the second
+        timed = TimedModel(model)
+        generator = Generator(timed)
+        t0 = time.perf_counter()
+        ids = generator.generate_ids(generator.tokenizer.encode(ctx), puzzle, token_count=tokens, constrained=False, fast_forward=False)
+    result["overhead_us_entry"] = round((time.perf_counter() - t0 - timed.forward_s) / max(1, len(ids)) * 1e6, 1)
+    return result
+
+
+def agreement(model, model_path, tokens):
+    """
+    Teacher-forced comparison with a cpu fp32 model on its own greedy trace of one puzzle: max |logit difference| and the
+    fraction of steps where both pick the same next id
+    """
+    import torch
+    from rwkv_model import RWKV
+    from generation import Generator
+    import puzzle_trace
+    from tools import generate_15_puzzle
+
+    reference = RWKV(model=model_path, strategy="cpu fp32", verbose=False)
+    generator = Generator(reference)
+    ctx = generator.tokenizer.encode(puzzle_trace.format_input(generate_15_puzzle(0)))
+    ids = ctx + generator.generate_ids(ctx, token_count=tokens)
+    out, state = model.forward(ids[:1], None)
+    ref, ref_state = reference.forward(ids[:1], None)
+    diff, same = 0.0, 0
+    for t in ids[1:]:
+        diff = max(diff, (out.float() - ref).abs().max().item())
+        same += int(torch.argmax(out).item() == torch.argmax(ref).item())
+        out, state = model.forward([t], state)
+        ref, ref_state = reference.forward([t], ref_state)
+    return {"fp32_max_diff": round(diff, 4), "fp32_argmax_agree": round(same / max(1, len(ids) - 1), 4)}
+
+
+def run_single(model_path, strategy, batch, tokens, compile_step=False, check=True):
+    """Benchmark one strategy in the current process and return a result dict."""
+    os.environ.setdefault("RWKV_JIT_ON", "1")
+    os.environ.setdefault("RWKV_CUDA_ON", "0")
+    import torch
+    from rwkv_model import RWKV
+
+    base_rss = rss_mb()
+    t0 = time.perf_counter()
+    model = RWKV(model=model_path, strategy=strategy, verbose=False)
+    load_time = time.perf_counter() - t0
+    model_rss = rss_mb() - base_rss
+
+    # weight-resident memory: model.w plus the tensors derived from it (stacked k/v/r/g), the pair table is l0_table_mb
+    weights = resident_mb(list(model.w.values()) + [t for k, t in model.derived.tensors.items() if not k.startswith("l0.")])
+    result = {"strategy": strategy, "int8_mm": model.CPU_INT8_MM, "load_s": round(load_time, 3), "weights_mb": round(weights, 1), "model_rss_mb": round(model_rss, 1)}
+    if compile_step:
+        t0 = time.perf_counter()
+        model.compile_step()
+        result["compile_s"] = round(time.perf_counter() - t0, 3)
+
+    _, state = model.forward([56, 54], None)
+    result["l0_table_mb"] = round(model.l0_table_mb, 1) if model.l0_table is not None else 0
+    for _ in range(10):
+        _, state = model.forward([1], state)
+    t0 = time.perf_counter()
+    for i in range(tokens):
+        _, state = model.forward([1 + i % 16], state)
+    result["tok_s_b1"] = round(tokens / (time.perf_counter() - t0), 1)
+    model.ffn_sparsity(reset=True)
+    result.update(decode_overhead(model, tokens))
+    if model.FFN_SPARSE:  # RWKV_FFN_SPARSE=1: channel-mix activation density on the puzzle trace decoded above
+        sparsity = model.ffn_sparsity()
+        result["ffn_density"] = round(sparsity["density"], 3)
+        result["ffn_rows_read"] = round(sparsity["rows_read"], 3)
+
+    if batch > 1:
+        state = model.zero_state_batch(batch)
+        ids = torch.arange(batch) % 16 + 1
+        for _ in range(3):
+            _, state = model.forward_batch(ids, state)
+        steps = max(1, tokens // 10)
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            _, state = model.forward_batch(ids, state)
+        result[f"tok_s_b{batch}"] = round(steps * batch / (time.perf_counter() - t0), 1)
+
+    result["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    if check:  # after peak RSS, so the reference model is not counted
+        result.update(agreement(model, model_path, tokens))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare RWKV strategies: load time, tokens/s and memory")
+    parser.add_argument("--model", default="rwkv_15puzzle_20241214.pth")
+    parser.add_argument("--strategy", nargs="+", default=["cpu fp32", "cpu fp32i8"])
+    parser.add_argument("--batch", type=int, default=64, help="batch size for the forward_batch measurement (1 = skip)")
+    parser.add_argument("--tokens", type=int, default=500, help="single-token steps per measurement")
+    parser.add_argument("--compile-step", action="store_true", help="run single-token steps through RWKV.compile_step()")
+    parser.add_argument("--int8-mm", action="store_true", help="run every i8 strategy twice, without and with RWKV_CPU_INT8_MM=1")
+    parser.add_argument("--no-check", action="store_true", help="skip the logit / argmax agreement check against cpu fp32")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_single(args.model, args.strategy[0], args.batch, args.tokens, args.compile_step, not args.no_check)))
+        return
+
+    # one process per strategy, so peak RSS is not shared between runs
+    rows = []
+    for strategy in args.strategy:
+        cmd = [sys.executable, __file__, "--single", "--model", args.model, "--strategy", strategy, "--batch", str(args.batch), "--tokens", str(args.tokens)] + (["--compile-step"] if args.compile_step else []) + (["--no-check"] if args.no_check else [])
+        envs = [dict(os.environ, RWKV_CPU_INT8_MM=flag) for flag in "01"] if args.int8_mm and "i8" in strategy else [None]
+        for env in envs:
+            out = subprocess.run(cmd, capture_output=True, text=True, check=True, env=env).stdout
+            rows.append(json.loads(out.strip().splitlines()[-1]))
+
+    keys = list(rows[0].keys())
+    print(" | ".join(k.rjust(14) for k in keys))
+    for row in rows:
+        print(" | ".join(str(row[k]).rjust(14) for k in keys))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@ import tkinter as tk
 from tkinter import messagebox, font
 import random
 import time
-from threading import Thread
+from threading import Event, Thread
 from tools import generate_15_puzzle
 
 
@@ -42,6 +42,8 @@ class ModernFifteenPuzzle:
         self.buttons = []
         self.timer_id = None
         self.is_model_running = False
+        self.model_thread = None
+        self.cancel = None  # Event of the current model run, set by New Game
 
         self.manual_control = True
         self.timer_running = False
@@ -101,10 +103,15 @@ class ModernFifteenPuzzle:
             btn.bind("<Leave>", lambda e, b=btn: b.configure(bg=self.colors["button_bg"]) if b["state"] != "disabled" else None)
 
     def start_model(self):
+        if self.model_thread is not None and self.model_thread.is_alive():
+            return  # a cancelled run is still finishing its last step
         if not self.is_model_running and self.manual_control:
             self.is_model_running = True
             self.manual_control = False
             self.set_buttons_state("disabled")
+            self.control_frame.winfo_children()[0].configure(state="normal")  # New Game stays available, it cancels the run
+            cancel = Event()
+            self.cancel = cancel
 
             self.reasoning_text.configure(state="normal")
             self.reasoning_text.delete(1.0, tk.END)
@@ -112,6 +119,8 @@ class ModernFifteenPuzzle:
 
             def recall(text, move=None):
                 def update():
+                    if cancel.is_set():  # queued before New Game, must not touch the new board
+                        return
                     self.update_reasoning(text)
                     if move and move != "None":
                         self.make_move(move)
@@ -120,19 +129,28 @@ class ModernFifteenPuzzle:
 
             def run_model():
                 try:
-                    self.model.solve(self, recall)
+                    self.model.solve(self, recall, cancel)
                 finally:
 
                     def restore():
+                        if cancel.is_set():  # New Game has already reset the board and controls
+                            return
+                        self.cancel = None
                         self.set_buttons_state("normal")
                         self.manual_control = True
                         self.is_model_running = False
 
                     self.master.after(0, restore)
 
-            Thread(target=run_model, daemon=True).start()
+            self.model_thread = Thread(target=run_model, daemon=True)
+            self.model_thread.start()
 
     def new_game(self):
+        if self.cancel is not None:
+            self.cancel.set()  # the generator stops at its next step
+            self.cancel = None
+            self.set_buttons_state("normal")
+
         if self.timer_id:
             self.master.after_cancel(self.timer_id)
             self.timer_id = None
@@ -374,13 +392,10 @@ class DummyModel:
         os.environ["RWKV_CUDA_ON"] = "0"
 
         from rwkv_model import RWKV
-        from rwkv.utils import PIPELINE, PIPELINE_ARGS
-        from rwkv.rwkv_tokenizer import TRIE_TOKENIZER
+        from generation import Generator
 
         self.model = RWKV(model=MODEL_PATH, strategy="cuda fp16", verbose=False)
-        self.pipeline = PIPELINE(self.model, "rwkv_vocab_v20230424")
-        self.pipeline.tokenizer = TRIE_TOKENIZER("puzzle15_vocab.txt")
-        self.gen_args = PIPELINE_ARGS(top_k=1, alpha_frequency=0, alpha_presence=0, token_stop=[59])
+        self.generator = Generator(self.model)
 
         self.model.forward([0, 1], None)
 
@@ -389,23 +404,21 @@ class DummyModel:
 
     def my_callback(self, text):
         # print(text, end='', flush=True)
-        # if text in ['UP ', 'DOWN ', 'RIGHT ', 'LEFT ']:
-        #     print('rrr', text)
-        #     time.sleep(0.02)
-        self.history += text
-        if text.endswith("\n"):
-            lines = self.history.strip().split("\n")
-            last_line = lines[-1]
-            if last_line.startswith("> Move"):
-                # print(last_line)
-                move = last_line.split(" ")[-1].strip()
-                self.ui_callback(text, move)
+        # the generator may hand over several lines at once (prefilled tokens), report them line by line
+        for piece in text.splitlines(keepends=True):
+            self.history += piece
+            if piece.endswith("\n"):
+                lines = self.history.strip().split("\n")
+                last_line = lines[-1]
                 self.history = ""
-                return
-            self.history = ""
-        self.ui_callback(text, "None")
-
-    def solve(self, puzzle, recall):
+                if last_line.startswith("> Move"):
+                    # print(last_line)
+                    move = last_line.split(" ")[-1].strip()
+                    self.ui_callback(piece, move)
+                    continue
+            self.ui_callback(piece, "None")
+
+    def solve(self, puzzle, recall, cancel=None):
         self.ui_callback = recall
         self.history = ""
         # prepare input
@@ -419,8 +432,9 @@ class DummyModel:
         print(input_str)
         self.ui_callback(input_str, "None")
 
-        # generate solution
-        self.pipeline.generate(input_str, token_count=100000, args=self.gen_args, callback=self.my_callback)
+        # generate solution; constrained / fast_forward off so the model's own greedy ids are shown, as with PIPELINE
+        self.generator.generate(input_str, token_count=100000, constrained=False, fast_forward=False, callback=self.my_callback, cancel=cancel)
+        print(f"Stopped: {self.generator.stats['reason']}")
 
 
 def main():
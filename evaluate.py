@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import time
+
+
+def section_names():
+    from generate_data import STEPS
+
+    return ["prefix"] + [s.lstrip("# ") for s in STEPS] + ["output"]
+
+
+def evaluate_puzzle(model, puzzle, chunk_len=256, fsm=None):
+    """
+    Teacher-forced check of the model on the solver trace of one puzzle
+
+    The reference trace (prompt, reasoning and output up to the stop token) is run through RWKV.forward in chunked seq
+    mode with full_output, and the argmax at every position after the prompt is compared with the next reference id.
+    Up to the first mismatch this is exactly what greedy decoding would produce.
+    Args:
+        fsm: optional grammar.Grammar, to compare the argmax over the ids the trace grammar allows (constrained decoding)
+    Returns:
+        dict with tokens, errors, first_divergence (index after the prompt, None if greedy reproduces the trace) and
+        per-section [errors, tokens] (sections as puzzle_trace.step_lengths)
+    """
+    import torch
+    import puzzle_trace
+
+    tokenizer = puzzle_trace.get_tokenizer()
+    prompt = tokenizer.encode(puzzle_trace.format_input(puzzle))
+    target = puzzle_trace.draft_tokens(prompt, puzzle)
+    ids = prompt + target
+
+    outs, state = [], None
+    for i in range(0, len(ids) - 1, chunk_len):
+        out, state = model.forward(ids[i : min(i + chunk_len, len(ids) - 1)], state, full_output=True)
+        outs.append(out if out.dim() == 2 else out.unsqueeze(0))
+    logits = torch.cat(outs)[len(prompt) - 1 :]
+    if fsm is not None:
+        logits = logits + fsm.mask[[fsm.start] + fsm.walk(fsm.start, target)[:-1]]
+    wrong = (logits.argmax(dim=-1) != torch.tensor(target)).tolist()
+
+    sections = []
+    i = 0
+    for n in puzzle_trace.step_lengths(target):
+        sections.append([sum(wrong[i : i + n]), n])
+        i += n
+    return {
+        "tokens": len(target),
+        "errors": sum(wrong),
+        "first_divergence": wrong.index(True) if any(wrong) else None,
+        "sections": sections,
+    }
+
+
+def run(model_path, strategy, seeds, start=0, reverse_rate=0.2, reverse_steps=15, chunk_len=256, constrained=False, jsonl=None):
+    """Evaluate the model on the puzzles generate_15_puzzle gives for seeds start .. start+seeds-1; returns a summary dict"""
+    os.environ.setdefault("RWKV_JIT_ON", "1")
+    os.environ.setdefault("RWKV_CUDA_ON", "0")
+    from rwkv_model import RWKV
+    import grammar
+    from tools import generate_15_puzzle
+
+    model = RWKV(model=model_path, strategy=strategy, verbose=False)
+    fsm = grammar.get_grammar() if constrained else None
+    names = section_names()
+    sections = [[0, 0] for _ in names]
+    tokens = errors = exact = 0
+    divergence = []
+    out = open(jsonl, "w") if jsonl else None
+    t0 = time.perf_counter()
+    for seed in range(start, start + seeds):
+        puzzle = generate_15_puzzle(seed, reverse_rate=reverse_rate, reverse_steps=reverse_steps)
+        result = evaluate_puzzle(model, puzzle, chunk_len, fsm)
+        tokens += result["tokens"]
+        errors += result["errors"]
+        if result["first_divergence"] is None:
+            exact += 1
+        else:
+            divergence.append(result["first_divergence"])
+        for total, (e, n) in zip(sections, result["sections"]):
+            total[0] += e
+            total[1] += n
+        if out:
+            out.write(json.dumps({"seed": seed, "puzzle": puzzle, **result}) + "\n")
+    if out:
+        out.close()
+    elapsed = time.perf_counter() - t0
+
+    return {
+        "puzzles": seeds,
+        "tokens": tokens,
+        "token_accuracy": round(1 - errors / max(1, tokens), 6),
+        "greedy_exact": round(exact / max(1, seeds), 4),
+        "mean_first_divergence": round(sum(divergence) / len(divergence), 1) if divergence else None,
+        "min_first_divergence": min(divergence) if divergence else None,
+        "section_error_rate": {name: round(e / n, 6) if n else None for name, (e, n) in zip(names, sections)},
+        "tok_s": round(tokens / elapsed, 1),
+        "seconds": round(elapsed, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teacher-forced evaluation of the model against generate_data.solve traces")
+    parser.add_argument("--model", default="rwkv_15puzzle_20241214.pth")
+    parser.add_argument("--strategy", default="cpu fp32")
+    parser.add_argument("--seeds", type=int, default=1000, help="number of puzzles")
+    parser.add_argument("--start", type=int, default=0, help="first seed")
+    parser.add_argument("--reverse-rate", type=float, default=0.2, help="generate_15_puzzle reverse_rate (share of reverse-play boards)")
+    parser.add_argument("--reverse-steps", type=int, default=15, help="generate_15_puzzle reverse_steps")
+    parser.add_argument("--chunk-len", type=int, default=256, help="tokens per seq-mode forward")
+    parser.add_argument("--constrained", action="store_true", help="argmax over the ids the trace grammar allows")
+    parser.add_argument("--jsonl", help="also write one result line per puzzle to this file")
+    args = parser.parse_args()
+
+    summary = run(args.model, args.strategy, args.seeds, args.start, args.reverse_rate, args.reverse_steps, args.chunk_len, args.constrained, args.jsonl)
+    rates = summary.pop("section_error_rate")
+    for k, v in summary.items():
+        print(f"{k:>22} | {v}")
+    print()
+    for name, rate in rates.items():
+        print(f"{name:>45} | {rate}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+import time
+
+import torch
+
+import grammar
+import puzzle_trace
+from puzzle_trace import OUTPUT_END
+
+
+class Generator:
+    """
+    Greedy decoding for the 15-puzzle model, optionally speculative
+
+    The model was trained to reproduce generate_data.solve token for token, so the solver is used as a draft:
+    a block of draft tokens is verified with one seq-mode forward and the longest prefix the model agrees with is
+    accepted. Speculation alone does not change the output: it is the same as greedy decoding (PIPELINE.generate with
+    top_k=1).
+
+    Without a draft (or after leaving it), tokens that are fully determined are not decoded but prefilled in one
+    seq forward: the board printed after each "> Move X" line (puzzle_trace.TraceTracker) and every position where
+    the trace grammar allows a single id (grammar.Grammar). The grammar also masks illegal ids before argmax.
+    These two (fast_forward, constrained, on by default) do change the output wherever the model would have picked
+    another id: the forced or legal id is used instead, so the result can differ from plain greedy decoding.
+    """
+
+    def __init__(self, model, chunk_len=256, draft_len=64, cache=None):
+        self.model = model
+        self.cache = cache  # optional state_cache.StateCache for the prompt
+        self.tokenizer = puzzle_trace.get_tokenizer()
+        self.chunk_len = chunk_len
+        self.draft_len = draft_len
+        self.stats = {}
+        self.state = None  # model state after the last generated token
+
+    def prefill(self, tokens, state=None):
+        out = None
+        while len(tokens) > 0:
+            out, state = self.model.forward(tokens[: self.chunk_len], state)
+            tokens = tokens[self.chunk_len :]
+        return out, state
+
+    def generate(self, ctx, token_count=500000, speculative=True, fast_forward=True, constrained=True, callback=None, state=None, retries=0, on_error=None, cancel=None, deadline=None):
+        """
+        Args:
+            ctx: prompt, usually puzzle_trace.format_input(puzzle)
+            token_count: maximum number of generated tokens
+            speculative: use the solver trace as draft
+            fast_forward: prefill the board echo after each move instead of decoding it
+            constrained: mask ids the trace grammar does not allow, and prefill positions where it allows only one
+            callback: called with each new piece of decoded text
+            retries: re-decode a step from its header checkpoint this many times at most when it makes an invalid move
+            on_error: what to do with an invalid move or board that retries did not fix: None (keep going, but stop on a
+                cycle or a step over its budget, puzzle_trace.RUNAWAY_ERRORS), "abort",
+                or a hook called with the error and the ids so far, returning True to keep going
+            cancel: object with is_set() (e.g. threading.Event), checked between forward calls; set it to stop
+            deadline: time.monotonic() value, generation stops at the first check after it
+        Why generation ended is in stats["reason"]: "stop" (stop token), "budget" (token_count), "error" (aborted by
+        on_error), "cycle" or "step budget" (runaway trace, on_error None), "cancelled" or "deadline".
+        speculative, fast_forward, constrained, retries and on_error are ignored if ctx is not a solver prompt.
+        Returns:
+            Generated text, without the stop token
+        """
+        decode = self.tokenizer.decode
+        tokens = self.generate_ids(
+            self.tokenizer.encode(ctx),
+            puzzle_trace.parse_input(ctx),
+            token_count=token_count,
+            speculative=speculative,
+            fast_forward=fast_forward,
+            constrained=constrained,
+            callback=(lambda ids: callback(decode(ids))) if callback else None,
+            state=state,
+            retries=retries,
+            on_error=on_error,
+            cancel=cancel,
+            deadline=deadline,
+        )
+        return decode(tokens)
+
+    def generate_ids(self, prompt, puzzle=None, token_count=500000, speculative=True, fast_forward=True, constrained=True, callback=None, state=None, retries=0, on_error=None, cancel=None, deadline=None):
+        """
+        Same as generate, on token ids: prompt is a list of ids, callback gets each list of new ids.
+        Without puzzle this is a plain greedy loop.
+        retries > 0 (needs puzzle): the state is checkpointed after every step header; when a move is illegal or a board
+        is wrong (puzzle_trace.TraceTracker.error) decoding rolls back to the last checkpoint and re-decodes the step with
+        the second-best id at its least certain decision, up to retries times per step. callback then only gets the ids
+        of steps that are done.
+        With a puzzle the trace is always checked as it is generated (board simulation of every move line and output
+        move, echoed boards, trace format, puzzle_trace.TraceTracker). The first problem not fixed by a retry is reported
+        in stats (error, error_token, error_s). Generation stops there with "abort", or a hook returning False, and with
+        the default on_error=None only on a runaway trace (a cycle, or a step over its budget); stats["tokens_saved"] is
+        then the part of token_count not spent.
+        cancel, deadline and stats["reason"] as in generate.
+        Returns:
+            Generated ids, without the stop token
+        """
+        t0 = time.perf_counter()
+        stats = {"tokens": 0, "forward_calls": 0, "draft_accepted": 0, "draft_rejected": 0, "forced": 0, "retries": 0, "rollback_tokens": 0, "error": None, "reason": None}
+        self.stats = stats
+        interrupted = self.interrupt(cancel, deadline)
+
+        if self.cache is not None and state is None and puzzle is not None and prompt == self.cache.prompt(puzzle):
+            out, state = self.cache.prefill(puzzle)
+        else:
+            out, state = self.prefill(prompt, state)
+            stats["forward_calls"] += (len(prompt) + self.chunk_len - 1) // self.chunk_len
+
+        if puzzle is None:
+            tokens, self.state, stats["reason"] = self.greedy(out, state, token_count, callback, interrupted)
+            stats["tokens"] += len(tokens)
+            stats["forward_calls"] += len(tokens)
+            return tokens
+
+        draft = puzzle_trace.draft_tokens(prompt, puzzle) if speculative else []
+        pos = 0  # position in draft, valid while the output still matches it
+        tracker = puzzle_trace.TraceTracker(puzzle) if fast_forward else None
+        fsm = grammar.get_grammar() if constrained else None
+        g = fsm.start if fsm is not None else None
+        # draft positions that would be prefilled off the draft; verification accepts them whatever the model predicts
+        draft_forced = self.forced_positions(draft, fsm, puzzle_trace.TraceTracker(puzzle) if tracker is not None else None)
+
+        checkpoints = retries > 0
+        validator = puzzle_trace.TraceTracker(puzzle)  # always on: a runaway trace stops here instead of at token_count
+        check = grammar.get_grammar()  # the format is checked even when decoding is not constrained
+        c = check.start if check is not None else None
+        checkpoint = None  # after the last step header: (token count, out, state, grammar states, draft position, tracker, validator)
+        decisions = []  # (index, top-2 margin, second best id) of ids the model chose since the checkpoint
+        override = {}  # index -> id to use instead of the argmax while retrying
+        tried = set()
+        attempts = 0
+        emitted = 0  # ids passed to callback
+
+        all_tokens = []
+        reason = "budget"
+        while len(all_tokens) < token_count:
+            if interrupted is not None and interrupted():
+                reason = interrupted()
+                break
+            n = len(all_tokens)
+            if pos < len(draft) and draft_forced[pos]:
+                token = draft[pos]
+            elif n in override:
+                token = override[n]
+            else:
+                logits = out if fsm is None else out + fsm.mask[g]
+                token = int(torch.argmax(logits))
+                if checkpoints:
+                    top = torch.topk(logits, 2)
+                    if top.values[1] > -float("inf"):
+                        decisions.append((n, float(top.values[0] - top.values[1]), int(top.indices[1])))
+
+            on_draft = pos < len(draft) and draft[pos] == token
+            limit = min([self.draft_len, token_count - n] + [i - n for i in override if i > n])
+            block = draft[pos : pos + limit] if on_draft else []
+            if checkpoints:  # a step header ends its forward call, so there is a state to checkpoint
+                block = self.cut_after_header(block)
+            if len(block) > 1:
+                saved = [s.clone() for s in state]  # kernels may update state in place
+                outs, state = self.model.forward(block, state, full_output=True)
+                stats["forward_calls"] += 1
+                states = fsm.walk(g, block) if fsm is not None else None
+                pred = torch.argmax(outs if states is None else outs + fsm.mask[states], dim=-1).tolist()
+                n = 1
+                while n < len(block) and (pred[n - 1] == block[n] or draft_forced[pos + n]):
+                    n += 1
+                if n < len(block):  # model disagrees at block[n], redo the accepted prefix to get its state
+                    stats["draft_rejected"] += len(block) - n
+                    block = block[:n]
+                    outs, state = self.model.forward(block, saved, full_output=True)
+                    stats["forward_calls"] += 1
+                    pos = len(draft)
+                else:
+                    pos += n
+                out = outs[-1]
+                stats["draft_accepted"] += n
+                new_tokens = block
+                g, _ = self.advance(fsm, g, tracker, block)
+            else:
+                pos = pos + 1 if on_draft else len(draft)
+                new_tokens = [token]
+                fed = new_tokens
+                # while off the draft, append the tokens that are fully determined
+                while OUTPUT_END not in fed and len(all_tokens) + len(new_tokens) < token_count:
+                    g, fed = self.advance(fsm, g, tracker, fed)
+                    fed = fed[: token_count - len(all_tokens) - len(new_tokens)]
+                    if checkpoints and new_tokens[-1] in grammar.STEP_HEADERS:
+                        break  # a forced id after a header is the only legal one, the masked argmax finds it again
+                    if not fed or pos < len(draft):
+                        break
+                    if checkpoints:
+                        fed = self.cut_after_header(fed)
+                    new_tokens = new_tokens + fed
+                    stats["forced"] += len(fed)
+                feed = [t for t in new_tokens if t != OUTPUT_END]
+                if feed:
+                    out, state = self.model.forward(feed, state)
+                    stats["forward_calls"] += 1
+            if fsm is not None and g is None:  # forced past the grammar, decode freely from here
+                fsm = None
+
+            validator.feed(new_tokens)
+            if c is not None:
+                c = check.step(c, new_tokens)
+                if c is None:
+                    validator.error = validator.error or "format"
+            retry = None
+            if validator.error and checkpoint is not None and attempts < retries:
+                retry = min((d for d in decisions if (d[0], d[2]) not in tried), key=lambda d: d[1], default=None)
+            if retry is not None:  # back to the last step header, take the second best id at the closest call
+                attempts += 1
+                tried.add((retry[0], retry[2]))
+                override = {retry[0]: retry[2]}
+                stats["retries"] += 1
+                stats["rollback_tokens"] += len(all_tokens) + len(new_tokens) - checkpoint[0]
+                count, out, state, (g, c), pos, tracker, validator = checkpoint
+                del all_tokens[count:]
+                out, state = out.clone(), [s.clone() for s in state]
+                tracker = tracker.copy() if tracker is not None else None
+                validator = validator.copy()
+                if fsm is None and constrained and g is not None:
+                    fsm = grammar.get_grammar()
+                decisions = []
+                continue
+            if validator.error:
+                if stats["error"] is None:
+                    stats.update(error=validator.error, error_token=len(all_tokens) + len(new_tokens), error_s=time.perf_counter() - t0)
+                runaway = on_error is None and validator.error in puzzle_trace.RUNAWAY_ERRORS
+                if runaway or on_error == "abort" or (callable(on_error) and not on_error(validator.error, all_tokens + new_tokens)):
+                    reason = validator.error if runaway else "error"
+                    all_tokens += [t for t in new_tokens if t != OUTPUT_END]
+                    stats["tokens"] = len(all_tokens)
+                    stats["tokens_saved"] = token_count - len(all_tokens)
+                    break
+                validator.error = None  # report the next one too
+
+            stop = OUTPUT_END in new_tokens
+            if stop:
+                new_tokens = new_tokens[: new_tokens.index(OUTPUT_END)]
+            all_tokens += new_tokens
+            stats["tokens"] = len(all_tokens)
+            if checkpoints and new_tokens and new_tokens[-1] in grammar.STEP_HEADERS:
+                validator.error = None  # whatever went wrong before this header is kept
+                checkpoint = (len(all_tokens), out.clone(), [s.clone() for s in state], (g, c), pos, tracker.copy() if tracker is not None else None, validator.copy())
+                decisions, override, tried, attempts = [], {}, set(), 0
+                if callback and emitted < len(all_tokens):
+                    callback(all_tokens[emitted:])
+                emitted = len(all_tokens)
+            elif callback and new_tokens and not checkpoints:
+                callback(new_tokens)
+                emitted = len(all_tokens)
+            if stop:
+                reason = "stop"
+                break
+
+        if callback and emitted < len(all_tokens):
+            callback(all_tokens[emitted:])
+        stats["reason"] = reason
+        self.state = state
+        return all_tokens
+
+    @staticmethod
+    def interrupt(cancel, deadline):
+        """None without cancel and deadline, else a check returning "cancelled", "deadline" or None"""
+        if cancel is None and deadline is None:
+            return None
+
+        def check():
+            if cancel is not None and cancel.is_set():
+                return "cancelled"
+            if deadline is not None and time.monotonic() >= deadline:
+                return "deadline"
+            return None
+
+        return check
+
+    @staticmethod
+    def cut_after_header(tokens):
+        for i, t in enumerate(tokens):
+            if t in grammar.STEP_HEADERS:
+                return tokens[: i + 1]
+        return tokens
+
+    def search(self, prompt, puzzle, beams=4, token_count=500000, constrained=True, cancel=None, deadline=None):
+        """
+        Beam search for a verified solution, all beams advanced by one RWKV.forward_batch per token
+
+        The prompt is run once and its state forked. Beams are ranked by total log-probability (over the ids the trace
+        grammar allows, if constrained); each carries a puzzle_trace.TraceTracker and is dropped as soon as it makes an
+        illegal move, prints a wrong board or plays an output move off the board. The first beam whose output solves
+        the puzzle wins. cancel and deadline as in generate, checked before every step.
+        Returns:
+            Ids of the solution without the stop token, or None if every beam failed, token_count ran out or the search
+            was interrupted (stats["reason"]: "stop", "failed", "budget", "cancelled", "deadline")
+        """
+        stats = {"tokens": 0, "forward_calls": 0, "pruned": 0, "finished_wrong": 0, "reason": "budget"}
+        self.stats = stats
+        interrupted = self.interrupt(cancel, deadline)
+        if self.cache is not None and prompt == self.cache.prompt(puzzle):
+            out, state = self.cache.prefill(puzzle)
+        else:
+            out, state = self.prefill(prompt)
+            stats["forward_calls"] += (len(prompt) + self.chunk_len - 1) // self.chunk_len
+        fsm = grammar.get_grammar() if constrained else None
+
+        state = self.model.stack_states([state])
+        out = out.unsqueeze(0)
+        # per beam: (ids, score, grammar state, tracker)
+        live = [([], 0.0, fsm.start if fsm is not None else None, puzzle_trace.TraceTracker(puzzle))]
+        for _ in range(token_count):
+            if interrupted is not None and interrupted():
+                stats["reason"] = interrupted()
+                return None
+            logits = out if fsm is None else out + fsm.mask[[b[2] for b in live]]
+            logp = torch.log_softmax(logits, dim=-1)
+            scores = torch.tensor([b[1] for b in live]).unsqueeze(1) + logp
+            top = torch.topk(scores.flatten(), min(2 * beams, scores.numel()))
+
+            parents, tokens, survivors = [], [], []
+            for score, flat in zip(top.values.tolist(), top.indices.tolist()):
+                if score == -float("inf") or len(survivors) == beams:
+                    break
+                parent, token = divmod(flat, logp.shape[1])
+                ids, _, g, tracker = live[parent]
+                tracker = tracker.copy()
+                tracker.feed([token])
+                if tracker.error:
+                    stats["pruned"] += 1
+                    continue
+                if token == OUTPUT_END:
+                    if tracker.solved():
+                        stats["tokens"] += 1
+                        stats["reason"] = "stop"
+                        self.state = self.model.unstack_state(state, parent)
+                        return ids
+                    stats["finished_wrong"] += 1
+                    continue
+                parents.append(parent)
+                tokens.append(token)
+                survivors.append((ids + [token], score, fsm.step(g, [token]) if fsm is not None else None, tracker))
+            if not survivors:
+                stats["reason"] = "failed"
+                return None
+
+            index = torch.tensor(parents, dtype=torch.long)
+            state = [s.index_select(0, index.to(s.device)) for s in state]
+            out, state = self.model.forward_batch(tokens, state)
+            stats["tokens"] += len(tokens)
+            stats["forward_calls"] += 1
+            live = survivors
+        return None
+
+    def greedy(self, out, state, token_count, callback=None, interrupted=None):
+        """Plain greedy loop: argmax on the logits, stop on OUTPUT_END; kept minimal, it runs once per token"""
+        forward = self.model.forward
+        tokens = []
+        append = tokens.append
+        for _ in range(token_count):
+            if interrupted is not None and interrupted():
+                return tokens, state, interrupted()
+            token = int(out.argmax())
+            if token == OUTPUT_END:
+                return tokens, state, "stop"
+            append(token)
+            if callback:
+                callback([token])
+            out, state = forward([token], state)
+        return tokens, state, "budget"
+
+    @classmethod
+    def forced_positions(cls, draft, fsm, tracker):
+        flags = []
+        expected = []
+        g = fsm.start if fsm is not None else None
+        for token in draft:
+            flags.append(len(expected) > 0)
+            expected = expected[1:]
+            g, forced = cls.advance(fsm, g, tracker, [token])
+            if not expected:
+                expected = forced
+        return flags
+
+    @staticmethod
+    def advance(fsm, g, tracker, tokens):
+        """
+        Move the grammar state and the board tracker over tokens
+        Returns:
+            New grammar state, and the ids that must follow (board echo, or the single id the grammar allows)
+        """
+        if fsm is not None and g is not None:
+            g = fsm.step(g, tokens)
+        forced = tracker.feed(tokens) if tracker is not None else []
+        if not forced and fsm is not None and g is not None and fsm.forced[g] >= 0:
+            forced = [fsm.forced[g]]
+        return g, forced
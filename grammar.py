@@ -0,0 +1,253 @@
+import torch
+
+from generate_data import FORMULA_A, FORMULA_B, STEPS
+from puzzle_trace import (
+    BOARD_END,
+    BOARD_START,
+    DIRECTION_TOKEN,
+    MOVE,
+    NEWLINE,
+    OUTPUT_END,
+    OUTPUT_START,
+    REASONING_END,
+    REASONING_START,
+    VOCAB_SIZE,
+)
+
+# remaining token ids of puzzle15_vocab.txt, only needed by the grammar
+STEP_TOKEN = {step: 33 + i for i, step in enumerate(STEPS)}
+STEP_HEADERS = frozenset(STEP_TOKEN.values())
+CHECK_POSITION = 62
+MOVE_BLANK = 63
+NOT_IN_PLACE = 66
+IN_PLACE = 67
+PLANNED_PATH = 68
+ADJUST = 69
+CHECK_SPECIAL = 71
+SPECIAL = {"A": 72, "B": 73}
+FORMULA = {"A": 74, "B": 75}
+PLACE = {5: 76, 10: 77, 13: 78, 16: 79}
+FINETUNE_COMPLETE = 80
+NOT_SPECIAL = 81
+
+NUMBERS = range(1, 17)
+COORDS = range(17, 33)
+DIRECTIONS = range(50, 54)
+
+
+def coord_token(position):
+    return 17 + position[0] * 4 + position[1]
+
+
+# ---------------------------------------------------------------- regular expressions over token ids
+# An expression is a function that wires a fragment into the NFA between two given states.
+
+
+class _NFA:
+    def __init__(self):
+        self.edges = []  # per state: list of (token set, next state)
+        self.eps = []  # per state: list of next states
+
+    def new_state(self):
+        self.edges.append([])
+        self.eps.append([])
+        return len(self.edges) - 1
+
+
+def tok(*ids):
+    ids = frozenset(i for x in ids for i in (x if isinstance(x, range) else [x]))
+    return lambda nfa, a, b: nfa.edges[a].append((ids, b))
+
+
+def seq(*exprs):
+    def build(nfa, a, b):
+        for e in exprs[:-1]:
+            m = nfa.new_state()
+            e(nfa, a, m)
+            a = m
+        exprs[-1](nfa, a, b)
+
+    return build
+
+
+def alt(*exprs):
+    def build(nfa, a, b):
+        for e in exprs:
+            e(nfa, a, b)
+
+    return build
+
+
+def star(expr):
+    def build(nfa, a, b):
+        m = nfa.new_state()
+        nfa.eps[a].append(m)
+        expr(nfa, m, m)
+        nfa.eps[m].append(b)
+
+    return build
+
+
+def plus(expr):
+    return seq(expr, star(expr))
+
+
+def ids(tokens):
+    return seq(*[tok(t) for t in tokens])
+
+
+# ---------------------------------------------------------------- the trace grammar
+
+
+def board():
+    return seq(tok(BOARD_START), *[seq(tok(NUMBERS), tok(NUMBERS), tok(NUMBERS), tok(NUMBERS), tok(NEWLINE)) for _ in range(4)], tok(BOARD_END))
+
+
+def move(direction=None):
+    d = tok(DIRECTIONS) if direction is None else tok(DIRECTION_TOKEN[direction])
+    return seq(tok(MOVE), d, tok(NEWLINE), board())
+
+
+def move_blank(target=None):
+    c = tok(COORDS) if target is None else tok(coord_token(target))
+    return seq(tok(MOVE_BLANK), c, tok(NEWLINE), star(move()))
+
+
+def planned():
+    return seq(tok(PLANNED_PATH), plus(tok(COORDS)), tok(NEWLINE), plus(seq(move_blank(), tok(ADJUST), move())))
+
+
+# special-case branches of generate_data.solve: step -> (case, blank target, formula)
+SPECIAL_CASES = {
+    3: ("A", (1, 1), FORMULA_A),
+    8: ("A", (2, 1), FORMULA_A),
+    11: ("B", (3, 0), FORMULA_B),
+    14: ("B", (3, 1), FORMULA_B),
+}
+# place steps: step -> (blank target, moves)
+PLACE_STEPS = {
+    4: ((0, 3), ["LEFT", "DOWN"]),
+    9: ((1, 3), ["LEFT", "DOWN"]),
+    12: ((3, 0), ["UP", "RIGHT"]),
+    15: ((3, 1), ["UP", "RIGHT"]),
+}
+
+
+def step(i):
+    header = tok(STEP_TOKEN[STEPS[i]])
+    if "Move" in STEPS[i]:
+        body = planned()
+        if i in SPECIAL_CASES:
+            case, target, formula = SPECIAL_CASES[i]
+            special = seq(
+                tok(SPECIAL[case]),
+                move_blank(target),
+                tok(FORMULA[case]),
+                ids([DIRECTION_TOKEN[d] for d in formula]),
+                tok(NEWLINE),
+                *[move(d) for d in formula],
+            )
+            body = seq(tok(CHECK_SPECIAL), alt(special, seq(tok(NOT_SPECIAL), body)))
+        return seq(header, tok(CHECK_POSITION), tok(COORDS), tok(NEWLINE), alt(tok(IN_PLACE), seq(tok(NOT_IN_PLACE), body)))
+    if "Place" in STEPS[i]:
+        target, moves = PLACE_STEPS[i]
+        return seq(header, move_blank(target), tok(PLACE[i + 1]), *[move(d) for d in moves])
+    return seq(header, star(move()), tok(FINETUNE_COMPLETE))
+
+
+def trace():
+    """Everything the model writes after the prompt, up to and including the stop token"""
+    return seq(
+        tok(NEWLINE),
+        tok(REASONING_START),
+        *[step(i) for i in range(len(STEPS))],
+        tok(REASONING_END),
+        tok(NEWLINE),
+        tok(OUTPUT_START),
+        star(tok(DIRECTIONS)),
+        tok(NEWLINE),
+        tok(OUTPUT_END),
+    )
+
+
+class Grammar:
+    """
+    DFA over token ids compiled from a regular expression (by default the solver trace)
+
+    States are ints; step() returns None for an illegal token. mask[state] is 0 for legal ids and -inf otherwise,
+    forced[state] is the only legal id or -1.
+    """
+
+    def __init__(self, expr=None):
+        nfa = _NFA()
+        start, end = nfa.new_state(), nfa.new_state()
+        (expr or trace())(nfa, start, end)
+
+        def closure(states):
+            stack, seen = list(states), set(states)
+            while stack:
+                for t in nfa.eps[stack.pop()]:
+                    if t not in seen:
+                        seen.add(t)
+                        stack.append(t)
+            return frozenset(seen)
+
+        # subset construction
+        first = closure([start])
+        index = {first: 0}
+        todo = [first]
+        self.next = []
+        self.accept = set()
+        while todo:
+            current = todo.pop()
+            i = index[current]
+            while len(self.next) <= i:
+                self.next.append({})
+            if end in current:
+                self.accept.add(i)
+            targets = {}
+            for s in current:
+                for tokens, t in nfa.edges[s]:
+                    for token in tokens:
+                        targets.setdefault(token, set()).add(t)
+            for token, t in targets.items():
+                key = closure(t)
+                if key not in index:
+                    index[key] = len(index)
+                    todo.append(key)
+                self.next[i][token] = index[key]
+        self.start = 0
+
+        self.mask = torch.full((len(self.next), VOCAB_SIZE), -float("inf"))
+        self.forced = [-1] * len(self.next)
+        for i, edges in enumerate(self.next):
+            self.mask[i, list(edges)] = 0
+            if len(edges) == 1 and i not in self.accept:
+                self.forced[i] = next(iter(edges))
+
+    def step(self, state, tokens):
+        for token in tokens:
+            state = self.next[state].get(token)
+            if state is None:
+                return None
+        return state
+
+    def walk(self, state, tokens):
+        """States after each prefix of tokens, or None if tokens leave the grammar"""
+        states = []
+        for token in tokens:
+            state = self.next[state].get(token)
+            if state is None:
+                return None
+            states.append(state)
+        return states
+
+
+_grammar = None
+
+
+def get_grammar():
+    global _grammar
+    if _grammar is None:
+        _grammar = Grammar()
+    return _grammar
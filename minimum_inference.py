@@ -4,13 +4,10 @@ os.environ["RWKV_JIT_ON"] = "1"
 os.environ["RWKV_CUDA_ON"] = "0"
 
 from rwkv_model import RWKV
-from rwkv.utils import PIPELINE, PIPELINE_ARGS
-from rwkv.rwkv_tokenizer import TRIE_TOKENIZER
+from generation import Generator
 
 model = RWKV(model="rwkv_15puzzle_20241214.pth", strategy="cuda fp16", verbose=False)
-pipeline = PIPELINE(model, "rwkv_vocab_v20230424")
-pipeline.tokenizer = TRIE_TOKENIZER("puzzle15_vocab.txt")
-gen_args = PIPELINE_ARGS(top_k=1, alpha_frequency=0, alpha_presence=0, token_stop=[59])
+generator = Generator(model)  # greedy, stops on </output>
 
 input_str = """<input>
 <board>
@@ -23,7 +20,14 @@ input_str = """<input>
 """
 
 print(f'{" Model input ":-^100}\n{input_str}\n{" Model output ":-^100}')
-solution = pipeline.generate(input_str, token_count=500000, args=gen_args, callback=lambda x: print(x, end="", flush=True))
+# moves and boards are checked as they are generated; stop at the first invalid one instead of running on
+# constrained / fast_forward off: every id is the model's own argmax, as with PIPELINE greedy (the solver-trace draft only
+# skips forward calls, it does not change the output)
+solution = generator.generate(input_str, token_count=500000, constrained=False, fast_forward=False, callback=lambda x: print(x, end="", flush=True), on_error="abort")
+stats = generator.stats
+print(f'\n{"-" * 100}\nStopped: {stats["reason"]} after {stats["tokens"]} tokens')
+if stats["error"]:
+    print(f'\n{"-" * 100}\nAborted: {stats["error"]} at token {stats["error_token"]} after {stats["error_s"]:.2f}s, {stats["tokens_saved"]} tokens of the budget not spent')
 
 # check if the solution is correct
 from tools import is_solution
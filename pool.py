@@ -0,0 +1,162 @@
+import itertools
+import os
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+
+def solve_puzzle(generator, puzzle, token_count=20000, **kwargs):
+    """
+    Solve one board with a generation.Generator, stopping at the first invalid move or board
+    Args:
+        puzzle: 4x4 list of numbers
+        kwargs: more Generator.generate_ids arguments
+    Returns:
+        dict with solution (list of moves), valid (tools.is_solution), tokens, error (TraceTracker error or None),
+        reason (why generation ended, Generator.generate), seconds
+    """
+    import puzzle_trace
+    from tools import is_solution
+
+    t0 = time.perf_counter()
+    tokenizer = generator.tokenizer
+    kwargs.setdefault("on_error", "abort")
+    ids = generator.generate_ids(tokenizer.encode(puzzle_trace.format_input(puzzle)), puzzle, token_count=token_count, **kwargs)
+    text = tokenizer.decode(ids)
+    solution = text.split("<output>")[-1].strip().split() if "<output>" in text else []
+    return {
+        "solution": solution,
+        "valid": is_solution(puzzle, solution),
+        "tokens": len(ids),
+        "error": generator.stats.get("error"),
+        "reason": generator.stats["reason"],
+        "seconds": round(time.perf_counter() - t0, 4),
+    }
+
+
+def worker(index, cores, threads, model, strategy, weights, token_count, tasks, results):
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    from rwkv_model import RWKV
+    from generation import Generator
+
+    generator = Generator(RWKV(model=model, strategy=strategy, verbose=False, weights=weights))
+    results.put(("ready", index, None))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        i, puzzle = task
+        try:
+            result = solve_puzzle(generator, puzzle, token_count)
+        except Exception as e:  # report, keep the worker alive for the next board
+            result = {"solution": [], "valid": False, "tokens": 0, "error": f"exception: {e!r}", "reason": "error", "seconds": 0.0}
+        result["worker"] = index
+        results.put(("done", i, result))
+
+
+class SolverPool:
+    """
+    Solve many boards in worker processes that share one copy of the weights
+
+    The model is loaded (and converted) once here; RWKV.shared_weights moves the converted weights and the tensors
+    derived from them (stacked k/v/r/g, layer 0 table) to shared memory, and every worker builds its RWKV on those
+    pages. Each worker is pinned to its own threads cores (os.sched_setaffinity) and runs with that many torch threads,
+    since intra-op threading does little for the model's small GEMVs; boards go to whichever worker is free.
+    """
+
+    def __init__(self, model="rwkv_15puzzle_20241214.pth", strategy="cpu fp32", workers=None, threads=1, token_count=20000):
+        os.environ.setdefault("RWKV_JIT_ON", "1")
+        os.environ.setdefault("RWKV_CUDA_ON", "0")
+        from rwkv_model import RWKV
+
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        if workers is None:
+            workers = max(1, (len(cores) or os.cpu_count() or 1) // threads)
+        self.workers = workers
+        self.threads = threads
+        self.weights = RWKV(model=model, strategy=strategy, verbose=False).shared_weights()
+        self.weights_mb = sum(v.nbytes for v in self.weights.values() if torch.is_tensor(v)) / 2**20
+
+        ctx = mp.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.processes = []
+        for i in range(workers):
+            subset = [cores[(i * threads + j) % len(cores)] for j in range(threads)] if cores else None
+            p = ctx.Process(target=worker, args=(i, subset, threads, model, strategy, self.weights, token_count, self.tasks, self.results), daemon=True)
+            p.start()
+            self.processes.append(p)
+        for _ in range(workers):
+            self.results.get()  # ready
+
+    def imap(self, puzzles, ahead=None):
+        """
+        Yields (index, result) as boards are solved, in completion order; result as solve_puzzle plus worker
+        At most ahead boards (default two per worker) are queued at a time, so puzzles can be a stream.
+        """
+        boards = enumerate(puzzles)
+        pending = 0
+        for task in itertools.islice(boards, ahead or 2 * self.workers):
+            self.tasks.put(task)
+            pending += 1
+        while pending:
+            _, i, result = self.results.get()
+            pending -= 1
+            for task in itertools.islice(boards, 1):
+                self.tasks.put(task)
+                pending += 1
+            yield i, result
+
+    def solve(self, puzzles, sjf=False):
+        """
+        Results for a list of boards, in input order
+        sjf: dispatch the shortest predicted traces (puzzle_trace.trace_length) first, for lower mean latency
+        """
+        order = list(range(len(puzzles)))
+        if sjf:
+            import puzzle_trace
+
+            order.sort(key=lambda i: puzzle_trace.trace_length(puzzles[i]))
+        results = [None] * len(puzzles)
+        for i, result in self.imap(puzzles[i] for i in order):
+            results[order[i]] = result
+        return results
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for p in self.processes:
+            p.join()
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    from tools import generate_15_puzzle
+
+    parser = argparse.ArgumentParser(description="Solve generated boards with a process pool and report puzzles/s")
+    parser.add_argument("--model", default="rwkv_15puzzle_20241214.pth")
+    parser.add_argument("--strategy", default="cpu fp32")
+    parser.add_argument("--workers", type=int, default=None, help="default: usable cores // threads")
+    parser.add_argument("--threads", type=int, default=1, help="cores (and torch threads) per worker")
+    parser.add_argument("--puzzles", type=int, default=64)
+    parser.add_argument("--token-count", type=int, default=20000)
+    parser.add_argument("--sjf", action="store_true", help="shortest predicted trace first")
+    args = parser.parse_args()
+
+    puzzles = [generate_15_puzzle(seed) for seed in range(args.puzzles)]
+    with SolverPool(args.model, args.strategy, args.workers, args.threads, args.token_count) as pool:
+        t0 = time.perf_counter()
+        results = pool.solve(puzzles, args.sjf)
+        elapsed = time.perf_counter() - t0
+    print(f"{pool.workers} workers x {pool.threads} threads, {pool.weights_mb:.1f} MiB shared weights")
+    print(f"{args.puzzles} puzzles in {elapsed:.2f}s ({args.puzzles / elapsed:.2f} puzzles/s), valid {sum(r['valid'] for r in results)}")
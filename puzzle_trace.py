@@ -0,0 +1,238 @@
+import copy
+import os
+
+from rwkv.rwkv_tokenizer import TRIE_TOKENIZER
+
+from generate_data import solve
+from logger import DataLogger
+from tools import Board
+
+SOLVED = [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10, 11, 12], [13, 14, 15, 0]]
+OFFSET = {"UP": (-1, 0), "DOWN": (1, 0), "LEFT": (0, -1), "RIGHT": (0, 1)}
+
+# longest section of generate_data.solve traces in tokens, measured with step_lengths over 3000 puzzles (30% reverse
+# play, 1-60 steps): before the first step header, each of the 17 steps, and from </reasoning> to the stop token
+MAX_STEP_TOKENS = [2, 762, 607, 607, 504, 205, 557, 452, 452, 349, 205, 402, 373, 130, 297, 348, 130, 152, 182]
+STEP_BUDGET = [int(n * 1.5) + 8 for n in MAX_STEP_TOKENS]
+# solver traces never print the same board twice in a step
+MAX_BOARD_VISITS = 2
+# TraceTracker errors of a trace that would otherwise run until the token budget
+RUNAWAY_ERRORS = ("cycle", "step budget")
+
+VOCAB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "puzzle15_vocab.txt")
+
+# token ids of puzzle15_vocab.txt
+NUMBER_TOKEN = {n: n + 1 for n in range(16)}  # '0  ' .. '15 '
+DIRECTION_TOKEN = {"UP": 50, "DOWN": 51, "LEFT": 52, "RIGHT": 53}
+TOKEN_DIRECTION = {v: k for k, v in DIRECTION_TOKEN.items()}
+BOARD_START = 54
+BOARD_END = 55
+INPUT_START = 56
+INPUT_END = 57
+OUTPUT_START = 58
+OUTPUT_END = 59  # stop token
+REASONING_START = 60
+REASONING_END = 61
+STEP_HEADER = range(33, 50)  # "### Step N: ..." for the 17 steps of generate_data.STEPS
+MOVE = 64
+NEWLINE = 82
+VOCAB_SIZE = 83
+
+_tokenizer = None
+_line_ids = {}  # trace line -> number of ids, for trace_length
+
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = TRIE_TOKENIZER(VOCAB_FILE)
+    return _tokenizer
+
+
+def format_input(puzzle):
+    """
+    Build the model prompt for a puzzle, in the same format as the training data
+
+    Args:
+        puzzle: 4x4 list of numbers, 0 is the blank
+    Returns:
+        Prompt string ending with "</input>\\n"
+    """
+    return f"<input>\n{str(Board(puzzle))}\n</input>\n"
+
+
+def parse_input(ctx):
+    """
+    Recover the puzzle from a prompt built by format_input
+
+    Returns:
+        4x4 list of numbers, or None if ctx does not contain a board
+    """
+    if "<board>" not in ctx or "</board>" not in ctx:
+        return None
+    cells = ctx.split("<board>", 1)[1].split("</board>", 1)[0].split()
+    if len(cells) != 16 or not all(c.isdigit() for c in cells):
+        return None
+    numbers = [int(c) for c in cells]
+    if sorted(numbers) != list(range(16)):
+        return None
+    return [numbers[i : i + 4] for i in range(0, 16, 4)]
+
+
+def reference_trace(puzzle):
+    """Full solver trace for a puzzle (prompt, reasoning and output), as produced by generate_data.solve"""
+    logger = DataLogger(print_to_console=False)
+    solve(board=Board(puzzle), logger=logger)
+    return logger.log
+
+
+def draft_tokens(prompt, puzzle):
+    """
+    Token ids the solver would emit after the prompt, up to and including the stop token
+
+    Args:
+        prompt: prompt token ids, normally the encoding of format_input(puzzle)
+        puzzle: 4x4 list of numbers
+    Returns:
+        List of ids, or [] if prompt is not the start of the solver trace (so the caller falls back to plain decoding)
+    """
+    trace = get_tokenizer().encode(reference_trace(puzzle))
+    if trace[: len(prompt)] != prompt:
+        return []
+    draft = trace[len(prompt) :]
+    return draft[: draft.index(OUTPUT_END) + 1] if OUTPUT_END in draft else draft
+
+
+def trace_length(puzzle):
+    """
+    len(draft_tokens(prompt, puzzle)) without encoding the whole trace: the ids the model emits after the prompt if it
+    follows the solver, up to and including the stop token. Trace lines repeat a lot (board rows, move lines), so each
+    distinct line is encoded once and its length cached.
+    """
+    n = 0
+    for line in reference_trace(puzzle)[len(format_input(puzzle)) :].splitlines(keepends=True):
+        count = _line_ids.get(line)
+        if count is None:
+            if len(_line_ids) >= 2**17:
+                _line_ids.clear()
+            count = _line_ids[line] = len(get_tokenizer().encode(line))
+        n += count
+        if line == "</output>\n":
+            break
+    return n
+
+
+def step_lengths(ids):
+    """Tokens in each section of a trace (ids after the prompt), in the order of MAX_STEP_TOKENS"""
+    lengths = [0]
+    for token in ids:
+        if token in STEP_HEADER or token == REASONING_END:
+            lengths.append(0)
+        lengths[-1] += 1
+    return lengths
+
+
+def board_tokens(puzzle):
+    """Token ids of a board block ("<board>\\n" .. "</board>\\n") as the model prints it"""
+    ids = [BOARD_START]
+    for row in puzzle:
+        ids += [NUMBER_TOKEN[n] for n in row] + [NEWLINE]
+    return ids + [BOARD_END]
+
+
+class TraceTracker:
+    """
+    Follows the board through a trace as tokens arrive
+
+    After a "> Move X \\n" line the next 22 tokens are the new board, which is fully determined by the previous
+    board and the move. feed() returns those forced ids so the caller can prefill them in one seq forward.
+    Board blocks in the trace are read back as well, so the tracker re-syncs after an invalid move.
+    The moves after <output> are played on a copy of the puzzle (answer), like tools.is_solution does at the end.
+    error is set to the first problem seen: "illegal move", "wrong board" (differs from the tracked one), "bad board",
+    "illegal output move", "cycle" (a board printed more than MAX_BOARD_VISITS times in one step) or "step budget" (a
+    section longer than STEP_BUDGET).
+    """
+
+    def __init__(self, puzzle):
+        self.puzzle = puzzle
+        self.board = Board(puzzle) if puzzle is not None else None
+        self.tail = []  # last two tokens before the current newline
+        self.cells = None  # numbers of the board block being read
+        self.answer = None  # board after the output moves so far, once <output> is seen
+        self.section = 0  # index in STEP_BUDGET
+        self.section_tokens = 0
+        self.visits = {}  # board -> times printed in this step
+        self.error = None
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    @staticmethod
+    def play(board, direction):
+        i, j = board.locate(0)
+        di, dj = OFFSET[direction]
+        if not (0 <= i + di < 4 and 0 <= j + dj < 4):
+            return False
+        board.move(direction)
+        return True
+
+    def apply(self, direction):
+        return self.play(self.board, direction)
+
+    def solved(self):
+        """True if the output moves so far solve the puzzle"""
+        return self.answer is not None and self.answer.board == SOLVED
+
+    def feed(self, tokens):
+        """
+        Args:
+            tokens: newly generated (or prefilled) ids
+        Returns:
+            Forced board-echo ids if tokens ended with a complete move line, else []
+        """
+        forced = []
+        for token in tokens:
+            forced = []
+            if token in STEP_HEADER or token == REASONING_END:
+                self.section = min(self.section + 1, len(STEP_BUDGET) - 1)
+                self.section_tokens = 0
+                self.visits = {}
+            self.section_tokens += 1
+            if self.section_tokens > STEP_BUDGET[self.section]:
+                self.error = self.error or "step budget"
+            if self.cells is not None:
+                if token == BOARD_END:
+                    if sorted(self.cells) == list(range(16)):
+                        printed = Board([self.cells[i : i + 4] for i in range(0, 16, 4)])
+                        if self.board is not None and printed != self.board:
+                            self.error = self.error or "wrong board"
+                        self.board = printed
+                        key = tuple(self.cells)
+                        self.visits[key] = self.visits.get(key, 0) + 1
+                        if self.visits[key] > MAX_BOARD_VISITS:
+                            self.error = self.error or "cycle"
+                    else:
+                        self.error = self.error or "bad board"
+                    self.cells = None
+                elif 1 <= token <= 16:
+                    self.cells.append(token - 1)
+                continue
+            if token == BOARD_START:
+                self.cells = []
+                continue
+            if token == OUTPUT_START and self.puzzle is not None:
+                self.answer = Board(self.puzzle)
+            elif self.answer is not None and token in TOKEN_DIRECTION and not self.play(self.answer, TOKEN_DIRECTION[token]):
+                self.error = self.error or "illegal output move"
+                self.answer = None
+            if token != NEWLINE:
+                self.tail = self.tail[-1:] + [token]
+                continue
+            tail, self.tail = self.tail, []
+            if len(tail) == 2 and tail[0] == MOVE and tail[1] in TOKEN_DIRECTION and self.board is not None:
+                if self.apply(TOKEN_DIRECTION[tail[1]]):
+                    forced = board_tokens(self.board.board)
+                else:
+                    self.error = self.error or "illegal move"
+                    self.board = None  # lost until the model prints the next board
+        return forced
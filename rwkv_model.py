@@ -2,7 +2,7 @@
 # The RWKV Language Model - https://github.com/BlinkDL/RWKV-LM
 ########################################################################################################
 
-from typing import Optional
+from typing import List, Optional, Tuple
 import types, gc, os, time, re
 import torch
 import torch.nn as nn
@@ -119,6 +119,64 @@ else:
     def mm8_one(x, w, mx, rx, my, ry):
         return torch_mm8_one(x, w, mx, rx, my, ry)
 
+@MyStatic
+def torch_mm8_int(x, w, mx, rx, my, ry):
+    # CPU int8 path: w is the uint8 weight shifted to int8 (w - 128), so W = (w + 128.5) * ry * rx + my + mx
+    # ry is folded into the activation, which is quantized per row; the my/mx terms are applied exactly
+    N, M = w.shape[0], w.shape[1]
+    x2 = x.float().view(-1, N)
+    xr = x2 * ry.float().view(1, N)
+    scale = xr.abs().amax(dim=1, keepdim=True).clamp(min=1e-30) / 127
+    xq = torch.round(xr / scale).to(dtype=torch.int8)
+    y = torch._int_mm(xq, w).float() * scale + 128.5 * xr.sum(dim=1, keepdim=True)
+    y = y * rx.float() + x2 @ my.float() + x2.sum(dim=1, keepdim=True) * mx.float()
+    if len(x.shape) == 1:
+        return y.view(M).to(dtype=x.dtype)
+    return y.to(dtype=x.dtype)
+
+@MyStatic
+def wkv6_chunked(r, k, v, w, u, s, chunk_len: int):
+    # chunkwise-parallel form of the v6 recurrence: out_t = r_t @ (u * k_t^T v_t + s), s = k_t^T v_t + exp(w_t) * s
+    # r/k/v/w: [H, T, N] (w is the log decay, <= 0), u: [H, N, 1], s: [H, N, N]
+    # intra-chunk terms are computed for all chunks at once, only the state hand-over between chunks is sequential
+    # every decay product is exp of a non-positive cumulative sum, so nothing can overflow
+    H, T, N = r.shape
+    L = chunk_len
+    C = (T + L - 1) // L
+    pad = C * L - T
+    if pad > 0:
+        r = F.pad(r, (0, 0, 0, pad))
+        k = F.pad(k, (0, 0, 0, pad))
+        v = F.pad(v, (0, 0, 0, pad))
+        w = F.pad(w, (0, 0, 0, pad))
+    r = r.view(H, C, L, N)
+    k = k.view(H, C, L, N)
+    v = v.view(H, C, L, N)
+    w = w.view(H, C, L, N)
+
+    cw = torch.cumsum(w, dim=2) # decay up to and including t
+    cp = cw - w # decay up to t-1
+    cl = cw[:, :, -1:] # decay over the whole chunk
+
+    # strictly lower-triangular (t, j) pairs inside each chunk
+    ij = torch.tril_indices(L, L, -1, device=r.device)
+    ti = ij[0]
+    tj = ij[1]
+    a = torch.zeros((H, C, L, L), dtype=r.dtype, device=r.device)
+    a[:, :, ti, tj] = (r[:, :, ti] * k[:, :, tj] * (cp[:, :, ti] - cw[:, :, tj]).exp()).sum(-1)
+    out = a @ v + (r * u.view(H, 1, 1, N) * k).sum(-1, keepdim=True) * v
+
+    kv = (k * (cl - cw).exp()).transpose(-1, -2) @ v # [H, C, N, N] contribution of each chunk to the state
+    cl = cl.exp().transpose(-1, -2) # [H, C, N, 1]
+    ss = torch.empty((H, C, N, N), dtype=s.dtype, device=s.device)
+    for c in range(C):
+        ss[:, c] = s
+        s = kv[:, c] + cl[:, c] * s
+    out = out + (r * cp.exp()) @ ss
+
+    out = out.view(H, C * L, N)[:, :T].transpose(0, 1)
+    return out, s
+
 def mm8(x: torch.Tensor, w: torch.Tensor, mx: torch.Tensor, rx: torch.Tensor, my: torch.Tensor, ry: torch.Tensor):
     if len(x.shape) == 1:
         return mm8_one(x, w, mx, rx, my, ry)
@@ -136,6 +194,12 @@ def matmul(a, b, mx: Optional[torch.Tensor]=None, rx: Optional[torch.Tensor]=Non
         assert my is not None
         assert ry is not None
         return mm8(a, b, mx, rx, my, ry).to(output_dtype)
+    elif b.dtype == torch.int8:
+        assert mx is not None
+        assert rx is not None
+        assert my is not None
+        assert ry is not None
+        return torch_mm8_int(a, b, mx, rx, my, ry).to(output_dtype)
     else:
         raise ValueError("Unsupported dtype")
 
@@ -173,8 +237,31 @@ if os.environ.get('RWKV_DML_ON') == '1':
 
 ########################################################################################################
 
+class BoundLayer:
+    # everything forward needs for one block, resolved once at load time:
+    # att_w / ffn_w are the positional weight arguments of ATT / FFN (after x and the state slots)
+    # att_one_w: weight arguments of att_one / att_batch, att_w itself unless they take fused weights (RWKV.FUSED_MM)
+    __slots__ = ('att_one', 'att_seq', 'att_batch', 'att_batch_inplace', 'ffn_one', 'ffn_seq', 'att_w', 'att_one_w', 'ffn_w', 'state_offset', 'n_state', 'chunked', 'rescale', 'stream', 'device', 'atype')
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('BoundLayer is immutable')
+
+# v6 att_w: the name of each position (as built by bind_layers), for code that picks single weights out of the bundle
+V6_ATT_W = ['ln1_w', 'ln1_b', 'lx_w', 'lx_b', 'x_maa', 'w_maa', 'k_maa', 'v_maa', 'r_maa', 'g_maa', 'tm_w1', 'tm_w2', 'td_w1', 'td_w2', 't_decay', 't_first',
+    'akw', 'avw', 'arw', 'agw', 'aow', 'akmx', 'akrx', 'akmy', 'akry', 'avmx', 'avrx', 'avmy', 'avry', 'armx', 'arrx', 'army', 'arry', 'agmx', 'agrx', 'agmy', 'agry', 'aomx', 'aorx', 'aomy', 'aory']
+V6_ATT = {name: i for i, name in enumerate(V6_ATT_W)}
+
+def v6_att_pick(att_w, names):
+    return [att_w[V6_ATT[n]] for n in names]
+
+########################################################################################################
+
 class RWKV(MyModule):
-    def __init__(self, model, strategy, verbose = True, convert_and_save_and_exit = None):
+    def __init__(self, model, strategy, verbose = True, convert_and_save_and_exit = None, snapshot = True, weights = None):
         super().__init__()
         if verbose:
             prxxx = lambda *args, **kwargs: print(*args, **kwargs)
@@ -196,15 +283,46 @@ class RWKV(MyModule):
             self.RESCALE_LAYER = int(os.environ["RWKV_RESCALE_LAYER"]) # !!! NOTE: SEEMS YOU SHOULD SET IT TO 999 (disable) FOR RWKV-MUSIC MODELS !!!
         except:
             self.RESCALE_LAYER = 6 if 'fp16' in strategy else 0
+        # v6 seq mode: use the chunkwise-parallel WKV for T >= WKV_CHUNK_MIN_T (chunks of WKV_CHUNK_LEN tokens)
+        self.WKV_CHUNK_LEN = int(os.environ.get("RWKV_WKV_CHUNK_LEN", 8))
+        self.WKV_CHUNK_MIN_T = int(os.environ.get("RWKV_WKV_CHUNK_MIN_T", 8))
+        # i8 weights on CPU, opt-in: run a real int8 GEMM (torch._int_mm) instead of dequantizing the whole matrix on every
+        # call; faster, but the activations are quantized too (per row), so logits drift further from fp32 than plain i8
+        self.CPU_INT8_MM = os.environ.get("RWKV_CPU_INT8_MM") == '1'
+        # v6 layer 0 pair table, opt-in: tabulate layer 0's time-mix for every (previous token, token) pair, if it fits in
+        # L0_TABLE_MAX_MB; faster single-token steps, but (V + 1) * V * 5 * C floats (34 MB here, twice the weights)
+        self.L0_TABLE = os.environ.get("RWKV_L0_TABLE") == '1'
+        self.L0_TABLE_MAX_MB = float(os.environ.get("RWKV_L0_TABLE_MAX_MB", 256))
+        # v6 float weights: stack the k/v/r/g projections of each block into one [4, C, C] tensor (one bmm per token)
+        self.FUSED_MM = os.environ.get("RWKV_FUSED_MM") != '0'
+        # v6 float weights, opt-in: channel-mix value projection on the nonzero relu² activations only (rows of vw),
+        # dense when more than FFN_SPARSE_MAX_DENSITY of them are nonzero; counters in ffn_stats / ffn_sparsity()
+        self.FFN_SPARSE = os.environ.get("RWKV_FFN_SPARSE") == '1'
+        self.FFN_SPARSE_MAX_DENSITY = float(os.environ.get("RWKV_FFN_SPARSE_MAX_DENSITY", 0.1))
+        self.ffn_sparsity(reset=True)
         prxxx(f'RWKV_JIT_ON {os.environ["RWKV_JIT_ON"]} RWKV_CUDA_ON {os.environ["RWKV_CUDA_ON"]} RESCALE_LAYER {self.RESCALE_LAYER}\n')
 
         args.MODEL_NAME = args.MODEL_NAME.strip()
         if not args.MODEL_NAME.endswith('.pth'):
             args.MODEL_NAME += '.pth'
-        prxxx(f'Loading {args.MODEL_NAME} ...')
+
+        # snapshot: the converted weights of this model for this strategy / RESCALE_LAYER, written when the layers are first bound and
+        # memory-mapped afterwards (no conversion, zero-copy tensors, pages shared by every process using the same file)
+        snapshot_tag = re.sub(r'[^0-9a-zA-Z]+', '-', args.strategy_string) + f'-r{self.RESCALE_LAYER}' + ('-mm8' if self.CPU_INT8_MM and 'i8' in args.strategy_string else '')
+        args.snapshot_tag = snapshot_tag
+        args.snapshot_path = args.MODEL_NAME[:-4] + f'.{snapshot_tag}.snapshot.pth' if (snapshot and not convert_and_save_and_exit and weights is None) else None
+        load_snapshot = args.snapshot_path is not None and os.path.exists(args.snapshot_path) and os.path.getmtime(args.snapshot_path) >= os.path.getmtime(args.MODEL_NAME)
+
+        # weights: shared_weights() of an instance in another process, mapped instead of loading (model only names the model)
+        prxxx(f'Loading {"shared weights" if weights is not None else args.snapshot_path if load_snapshot else args.MODEL_NAME} ...')
         with torch.no_grad():
-            self.w = torch.load(args.MODEL_NAME, map_location='cpu') # load model to CPU first
-            gc.collect()
+            if weights is not None:
+                self.w = dict(weights)
+            elif load_snapshot:
+                self.w = torch.load(args.snapshot_path, map_location='cpu', mmap=True, weights_only=True)
+            else:
+                self.w = torch.load(args.MODEL_NAME, map_location='cpu') # load model to CPU first
+                gc.collect()
             w = self.w
 
             ALREADY_CONVERTED = False
@@ -218,6 +336,10 @@ class RWKV(MyModule):
                 del w['_strategy']
                 del w['_version']
                 del w['_rescale_layer']
+            # tensors derived from w (stacked k/v/r/g, layer 0 table), kept so the snapshot and shared_weights hand them on;
+            # snapshot: path to write once bind_layers has built them, saved: the derived keys already in that file
+            derived = {x[len('_derived.'):]: w.pop(x) for x in list(w) if x.startswith('_derived.')}
+            self.derived = types.SimpleNamespace(tensors=derived, snapshot=args.snapshot_path, saved=set(derived) if load_snapshot else None)
             
             args.n_embd = w['emb.weight'].shape[1]
             args.n_att = w['blocks.0.att.key.weight'].shape[0] # note: transposed matrix
@@ -239,7 +361,7 @@ class RWKV(MyModule):
                             self.version = max(5.2, self.version)
                 if 'time_maa' in x:
                     self.version = max(6, self.version)
-                if int(self.version) == 6 and 'time_faaaa' in x:
+                if int(self.version) == 6 and ('time_faaaa' in x or (ALREADY_CONVERTED and 'time_first' in x)):
                     args.n_head = w[x].shape[0]
             prxxx(f'Model detected: v{self.version:.1f}')
 
@@ -422,6 +544,8 @@ class RWKV(MyModule):
                             print('Note: You are running out of RAM. Get more CPU RAM. Now this will run much slower.')
                     elif DEVICE != 'cpu':
                         w[x] = w[x].to(device=DEVICE).contiguous()
+                    elif self.CPU_INT8_MM and w[x].dtype == torch.uint8:
+                        w[x] = (w[x].to(dtype=torch.int16) - 128).to(dtype=torch.int8).contiguous()
                     
                     if (dd.stream) or (DEVICE != 'cpu'):
                         try:
@@ -432,7 +556,7 @@ class RWKV(MyModule):
                         except:
                             pass
 
-                if 'ffn.value.weight' in x:
+                if 'ffn.value.weight' in x and not load_snapshot: # a snapshot is mapped as-is, nothing to free
                     gc.collect()
                     if 'cuda' in args.strategy_string:
                         torch.cuda.empty_cache()
@@ -449,22 +573,24 @@ class RWKV(MyModule):
                         prxxx('\n', end = '')
                         print_need_newline = False
                     dt = str(w[x].dtype).replace('torch.', '')
-                    dt = dt.replace('float32', 'f32').replace('bfloat16', 'bf16').replace('float16', 'f16').replace('uint8', 'i8')
+                    dt = dt.replace('float32', 'f32').replace('bfloat16', 'bf16').replace('float16', 'f16').replace('uint8', 'i8').replace('int8', 'i8')
                     prxxx(x.ljust(32), dt.rjust(4), str(w[x].device).rjust(8), shape, ' (pinned)' if w[x].is_pinned() else '')
                 else:
                     print_need_newline = True
                     prxxx('.', end = '', flush = True)
             
+            # here, not in bind_layers: with JIT on, self.w is copied into the ScriptModule when __init__ returns and
+            # later writes to it are lost, so the separate k/v/r/g weights would stay alive next to their stacked copy
+            self.stack_kvrg(w, derived)
+
             if convert_and_save_and_exit:
-                w['_strategy'] = args.strategy_string
-                w['_rescale_layer'] = self.RESCALE_LAYER
-                w['_version'] = '0.7'
                 if not convert_and_save_and_exit.endswith('.pth'):
                     convert_and_save_and_exit += '.pth'
                 prxxx(f'Saving to {convert_and_save_and_exit}...')
-                torch.save(w, convert_and_save_and_exit)
+                self.save_converted(convert_and_save_and_exit)
                 prxxx(f'Converted and saved. Now this will exit.')
                 exit(0)
+
             
             if self.version == 5.2 and os.environ["RWKV_CUDA_ON"] == '1':
                 HEAD_SIZE = args.n_att // args.n_head
@@ -531,11 +657,181 @@ class RWKV(MyModule):
                                 rwkv6.forward_fp32(B, T, C, H, state, r, k, v, eew, u, y)
                             return y, state
                 self.RWKV_6 = RWKV_6
-        
-            gc.collect()
+
+            if not load_snapshot:
+                gc.collect()
             if 'cuda' in args.strategy_string:
                 torch.cuda.empty_cache()
 
+    def save_converted(self, path):
+        # converted weights, the tensors derived from them (as _derived.*, views keep sharing their storage) and the
+        # settings they were converted with; written atomically so concurrent loaders never see a partial file
+        w = dict(self.w)
+        w.update({f'_derived.{k}': v for k, v in self.derived.tensors.items()})
+        w = {k: v.cpu().contiguous() if v.device.type != 'cpu' else v for k, v in w.items()}
+        w['_strategy'] = self.args.strategy_string
+        w['_rescale_layer'] = self.RESCALE_LAYER
+        w['_version'] = '0.7'
+        tmp = f'{path}.{os.getpid()}.tmp'
+        torch.save(w, tmp)
+        os.replace(tmp, path)
+
+    def shared_weights(self):
+        # converted weights and the tensors bind_layers derives from them, moved to shared memory in place; other processes
+        # pass the dict to RWKV(model, strategy, weights=...) and map the same pages instead of loading and converting
+        if any(str(dd.device) != 'cpu' for dd in self.strategy):
+            raise NotImplementedError('shared_weights needs a CPU model')
+        if not getattr(self, 'layers', None):
+            self.bind_layers()
+        w = dict(self.w)
+        w.update({f'_derived.{k}': v for k, v in self.derived.tensors.items()})
+        for v in w.values():
+            v.share_memory_()
+        w['_strategy'] = self.args.strategy_string
+        w['_rescale_layer'] = self.RESCALE_LAYER
+        w['_version'] = '0.7'
+        return w
+
+    def stack_kvrg(self, w, derived):
+        # v6 float weights with FUSED_MM: stack the k/v/r/g projections of each block into derived['blocks.i.att.kvrg.weight']
+        # [4, C, C] and make the separate weights in w views of it, so seq mode and the fused single-token path share memory
+        if self.version != 6.0 or not self.FUSED_MM:
+            return
+        for i in range(self.args.n_layer):
+            att = f'blocks.{i}.att.'
+            kvrg = [f'{att}key.weight', f'{att}value.weight', f'{att}receptance.weight', f'{att}gate.weight']
+            if self.strategy[i].stream or not all(w[x].dtype in [torch.float16, torch.bfloat16, torch.float32] for x in kvrg):
+                continue
+            kvrg_w = derived.get(f'{att}kvrg.weight')
+            if kvrg_w is None:
+                kvrg_w = derived[f'{att}kvrg.weight'] = torch.stack([w[x] for x in kvrg]).contiguous()
+            for j, x in enumerate(kvrg):
+                w[x] = kvrg_w[j]
+
+    def bind_layers(self):
+        # pre-resolve the ATT/FFN callables and their weight arguments, so forward does no dict lookups or version checks
+        w = self.w
+        args = self.args
+        derived = self.derived.tensors
+        self.layers = []
+        for i in range(args.n_layer):
+            bbb = f'blocks.{i}.'
+            att = f'blocks.{i}.att.'
+            ffn = f'blocks.{i}.ffn.'
+            dd = self.strategy[i]
+            cuda_applicable = os.environ["RWKV_CUDA_ON"] == '1' and 'cuda' in str(dd.device)
+            # placeholder for the *_mx/_rx/_my/_ry slots of non-uint8 weights (never read)
+            none = torch.empty(0, dtype=dd.atype, device=dd.device)
+
+            def mm(name):
+                if w[name].dtype in [torch.uint8, torch.int8]:
+                    return (w[name+'_mx'], w[name+'_rx'], w[name+'_my'], w[name+'_ry'])
+                return (none, none, none, none)
+
+            att_one = self.att_one
+            att_seq = self.cuda_att_seq if cuda_applicable else self.att_seq
+            att_batch = att_batch_inplace = None
+            if self.version == 5:
+                att_one, att_seq = self.att_one_v5, self.att_seq_v5
+            elif self.version == 5.1:
+                att_one, att_seq = self.att_one_v5_1, self.att_seq_v5_1
+            elif self.version == 5.2:
+                att_one = self.att_one_v5_1 # same as v5.1
+                att_seq = self.cuda_att_seq_v5_2 if cuda_applicable else self.att_seq_v5_2
+            elif self.version == 6.0:
+                att_one = self.att_one_v6_0
+                att_seq = self.cuda_att_seq_v6_0 if cuda_applicable else self.att_seq_v6_0
+                att_batch, att_batch_inplace = self.att_batch_v6_0, self.att_batch_v6_0_inplace
+            ffn_one, ffn_seq = (self.ffn_one_v6, self.ffn_seq_v6) if self.version >= 6.0 else (self.ffn_one, self.ffn_seq)
+            if self.version >= 6.0 and self.FFN_SPARSE and not dd.stream and w[f'{ffn}value.weight'].dtype in [torch.float16, torch.bfloat16, torch.float32]:
+                ffn_one = self.ffn_sparse_v6
+
+            att_mm = [f'{att}key.weight', f'{att}value.weight', f'{att}receptance.weight']
+            if self.version in [5.1, 5.2, 6.0]:
+                att_mm += [f'{att}gate.weight']
+            att_mm += [f'{att}output.weight']
+            att_w = [w[f'{bbb}ln1.weight'], w[f'{bbb}ln1.bias']]
+            if self.version >= 5:
+                att_w += [w[f'{att}ln_x.weight'], w[f'{att}ln_x.bias']]
+            if self.version == 6.0:
+                att_w += [w[f'{att}time_maa_x'], w[f'{att}time_maa_w'], w[f'{att}time_maa_k'], w[f'{att}time_maa_v'], w[f'{att}time_maa_r'], w[f'{att}time_maa_g']]
+                att_w += [w[f'{att}time_maa_w1'], w[f'{att}time_maa_w2'], w[f'{att}time_decay_w1'], w[f'{att}time_decay_w2']]
+            elif self.version in [5.1, 5.2]:
+                att_w += [w[f'{att}time_mix_k'], w[f'{att}time_mix_v'], w[f'{att}time_mix_r'], w[f'{att}time_mix_g']]
+            else:
+                att_w += [w[f'{att}time_mix_k'], w[f'{att}time_mix_v'], w[f'{att}time_mix_r']]
+            att_w += [w[f'{att}time_decay'], w[f'{att}time_first']]
+            att_w += [w[x] for x in att_mm]
+            for x in att_mm:
+                att_w += mm(x)
+
+            ffn_mm = [f'{ffn}key.weight', f'{ffn}value.weight', f'{ffn}receptance.weight']
+            ffn_w = [w[f'{bbb}ln2.weight'], w[f'{bbb}ln2.bias']]
+            if self.version >= 6.0:
+                ffn_w += [w[f'{ffn}time_maa_k'], w[f'{ffn}time_maa_r']]
+            else:
+                ffn_w += [w[f'{ffn}time_mix_k'], w[f'{ffn}time_mix_r']]
+            ffn_w += [w[x] for x in ffn_mm]
+            for x in ffn_mm:
+                ffn_w += mm(x)
+
+            # fused k/v/r/g (stack_kvrg): the separate weights in att_w are already views of the stacked one
+            att_one_w = att_w
+            kvrg_w = derived.get(f'{att}kvrg.weight') if self.FUSED_MM else None
+            if kvrg_w is not None:
+                att_one, att_batch, att_batch_inplace = self.att_one_v6_0_fused, self.att_batch_v6_0_fused, self.att_batch_v6_0_fused_inplace
+                att_one_w = v6_att_pick(att_w, ['ln1_w', 'ln1_b', 'lx_w', 'lx_b', 'x_maa']) + \
+                    [torch.stack(v6_att_pick(att_w, ['w_maa', 'k_maa', 'v_maa', 'r_maa', 'g_maa']))] + \
+                    v6_att_pick(att_w, ['tm_w1', 'tm_w2', 'td_w1', 'td_w2', 't_decay', 't_first']) + [kvrg_w] + \
+                    v6_att_pick(att_w, ['aow', 'aomx', 'aorx', 'aomy', 'aory'])
+
+            n_state = 5 if self.version == 4 else 3 # state: att slots..., ffn_xx
+            self.layers.append(BoundLayer(
+                att_one=att_one, att_seq=att_seq, att_batch=att_batch, att_batch_inplace=att_batch_inplace, ffn_one=ffn_one, ffn_seq=ffn_seq,
+                att_w=tuple(att_w), att_one_w=tuple(att_one_w), ffn_w=tuple(ffn_w),
+                state_offset=i*n_state, n_state=n_state,
+                chunked=(self.version == 6.0),
+                rescale=(self.RESCALE_LAYER > 0 and (i+1) % self.RESCALE_LAYER == 0),
+                stream=dd.stream, device=dd.device, atype=dd.atype,
+            ))
+
+        self.emb = w['emb.weight']
+        self.head_w = (w['ln_out.weight'], w['ln_out.bias'], w['head.weight']) + \
+            ((w['head.weight_mx'], w['head.weight_rx'], w['head.weight_my'], w['head.weight_ry']) if w['head.weight'].dtype in [torch.uint8, torch.int8] else ())
+
+        # layer 0 pair table: emb is already layer-normed, so layer 0's r/k/v/g/decay only depend on the token and the
+        # previous one (att_xx of layer 0 is ln1 of the previous embedding). Row prev*V+token, prev = V for a zero state.
+        # With a table the state gets one more element: the previous token id.
+        V, C = self.emb.shape
+        self.l0_table_mb = (V + 1) * V * 5 * C * 4 / 2**20
+        self.l0_table = None
+        l0 = self.layers[0]
+        if self.version == 6.0 and self.L0_TABLE and self.l0_table_mb <= self.L0_TABLE_MAX_MB and not l0.stream:
+            if 'l0.table' not in derived:
+                x = self.emb.to(dtype=l0.atype, device=l0.device)
+                ln_w, ln_b = v6_att_pick(l0.att_w, ['ln1_w', 'ln1_b'])
+                xx = F.layer_norm(x, (C,), weight=ln_w, bias=ln_b)
+                sx = torch.cat([xx, torch.zeros_like(xx[:1])]).repeat_interleave(V, dim=0)
+                _, r, k, v, g, ww = self.att_mix_v6_0(x.repeat(V + 1, 1), sx, *l0.att_w)
+                P = (V + 1) * V
+                derived['l0.table'] = torch.cat([r.view(P, C), k.view(P, C), v.view(P, C), g.float().view(P, C), ww.view(P, C)], dim=1).contiguous()
+                derived['l0.xx'] = xx
+            self.l0_table = derived['l0.table']
+            self.l0_xx = derived['l0.xx']
+            self.l0_pair_w = tuple(v6_att_pick(l0.att_w, ['t_first', 'lx_w', 'lx_b', 'aow', 'aomx', 'aorx', 'aomy', 'aory']))
+
+        # the snapshot is written here, with everything derived so far, so processes mapping it share those pages too;
+        # a snapshot loaded without some of them (say the table was off when it was written) is written again
+        snapshot = self.derived.snapshot
+        if snapshot is not None and (self.derived.saved is None or not set(derived) <= self.derived.saved):
+            try:
+                self.save_converted(snapshot)
+                self.derived.saved = set(derived)
+            except OSError as e:
+                print(f'Note: could not write snapshot {snapshot} ({e}), the model will be converted again next time.')
+            self.derived.snapshot = None
+        return self.layers
+
     def RUN_RWKV_5(self, B, T, C, H, state, r, k, v, w, u):
         return self.RWKV_5.apply(B, T, C, H, state, r, k, v, w, u)
 
@@ -579,6 +875,49 @@ class RWKV(MyModule):
         out = r * matmul(vx, vw, vmx, vrx, vmy, vry)
         return x + out, xx
 
+    @MyFunction
+    def ffn_key_v6(self, x, sx, ln_w, ln_b, k_maa, r_maa, kw, vw, rw, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry):
+        # ffn_one_v6 up to the value projection: returns xx, r and the relu² activations
+        xx = F.layer_norm(x, (x.shape[-1],), weight=ln_w, bias=ln_b)
+        sx = sx - xx
+        kx = xx + sx * k_maa
+        rx = xx + sx * r_maa
+
+        r = torch.sigmoid(matmul(rx, rw, rmx, rrx, rmy, rry))
+        vx = torch.relu(matmul(kx, kw, kmx, krx, kmy, kry)) ** 2
+        return xx, r, vx
+
+    def ffn_sparse_v6(self, x, sx, ln_w, ln_b, k_maa, r_maa, kw, vw, rw, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry):
+        # ffn_one_v6 (x [C] or [B, C]) with vw float: only the rows of vw where some activation is nonzero are used,
+        # unless their share is above FFN_SPARSE_MAX_DENSITY; not scripted, it branches on the data and counts
+        xx, r, vx = self.ffn_key_v6(x, sx, ln_w, ln_b, k_maa, r_maa, kw, vw, rw, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry)
+        nz = vx.ne(0)
+        active = (nz.any(0) if nz.dim() > 1 else nz).nonzero().squeeze(1)
+        stats = self.ffn_stats
+        stats.rows += vx.shape[0] if vx.dim() > 1 else 1
+        stats.nonzero += int(nz.sum())
+        stats.width += vx.numel()
+        if active.shape[0] <= self.FFN_SPARSE_MAX_DENSITY * vx.shape[-1]:
+            stats.sparse += 1
+            stats.gathered += active.shape[0]
+            out = vx.index_select(-1, active) @ vw.index_select(0, active)
+        else:
+            stats.dense += 1
+            stats.gathered += vx.shape[-1]
+            out = vx @ vw
+        return x + r * out, xx
+
+    def ffn_sparsity(self, reset=False):
+        # counters of ffn_sparse_v6, with the measured activation density and the share of vw rows actually read
+        st = dict(vars(self.ffn_stats)) if hasattr(self, 'ffn_stats') else {}
+        if st:
+            st['density'] = st['nonzero'] / st['width'] if st['width'] else 0.0
+            calls = st['sparse'] + st['dense']
+            st['rows_read'] = st['gathered'] * st['rows'] / calls / st['width'] if calls else 0.0
+        if reset: # a dict attribute would be copied by TorchScript on every access, so the counters live in a namespace
+            self.ffn_stats = types.SimpleNamespace(rows=0, nonzero=0, width=0, gathered=0, sparse=0, dense=0)
+        return st
+
     @MyFunction
     def ffn_seq_v6(self, x, sx, ln_w, ln_b, k_maa, r_maa, kw, vw, rw, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry):
         xx = F.layer_norm(x, (x.shape[-1],), weight=ln_w, bias=ln_b)
@@ -865,7 +1204,7 @@ class RWKV(MyModule):
         return x + out, xx, s
 
     @MyFunction
-    def att_seq_v6_0(self, x, sx, s, ln_w, ln_b, lx_w, lx_b, x_maa, w_maa, k_maa, v_maa, r_maa, g_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kw, vw, rw, gw, ow, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry, gmx, grx, gmy, gry, omx, orx, omy, ory):
+    def att_seq_v6_0(self, x, sx, s, ln_w, ln_b, lx_w, lx_b, x_maa, w_maa, k_maa, v_maa, r_maa, g_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kw, vw, rw, gw, ow, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry, gmx, grx, gmy, gry, omx, orx, omy, ory, chunk_len: int=0):
         H = t_decay.shape[0]
         N = x.shape[-1] // H
         T = x.shape[0]
@@ -895,15 +1234,19 @@ class RWKV(MyModule):
         w_for_k = w_for_k.squeeze(-1).permute(1, 2, 0)  # [H, N, T]
         k = k * w_for_k
         
-        w = torch.exp(-torch.exp(w.float()))
-        out = torch.empty((T, H, N), dtype=r.dtype, device=r.device)
-        for t in range(T):
-            rt = r[:,t:t+1,:]
-            kt = k[:,:,t:t+1]
-            vt = v[:,t:t+1,:]
-            at = matmul(kt, vt)
-            out[t] = (rt @ (t_first * at + s)).squeeze(1)
-            s = at + w[t] * s
+        if chunk_len > 0:
+            w = -torch.exp(w.float()).squeeze(-1).transpose(0, 1) # log decay [H, T, N]
+            out, s = wkv6_chunked(r, k.transpose(1, 2), v, w, t_first, s, chunk_len)
+        else:
+            w = torch.exp(-torch.exp(w.float()))
+            out = torch.empty((T, H, N), dtype=r.dtype, device=r.device)
+            for t in range(T):
+                rt = r[:,t:t+1,:]
+                kt = k[:,:,t:t+1]
+                vt = v[:,t:t+1,:]
+                at = matmul(kt, vt)
+                out[t] = (rt @ (t_first * at + s)).squeeze(1)
+                s = at + w[t] * s
 
         out = out.reshape(T, H*N)
         out = F.group_norm(out, num_groups=H, weight=lx_w, bias=lx_b, eps = 64e-5)
@@ -912,6 +1255,180 @@ class RWKV(MyModule):
 
         return x + out, xx[-1,:], s
 
+    @MyFunction
+    def att_mix_v6_0(self, x, sx, ln_w, ln_b, lx_w, lx_b, x_maa, w_maa, k_maa, v_maa, r_maa, g_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kw, vw, rw, gw, ow, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry, gmx, grx, gmy, gry, omx, orx, omy, ory):
+        # time-mix inputs of the WKV for B rows: x/sx [B, C] -> xx, r [B, H, 1, N], k [B, H, N, 1], v [B, H, 1, N], g [B, C], decay w [B, H, N, 1]
+        H = t_decay.shape[0]
+        N = x.shape[-1] // H
+        B = x.shape[0]
+
+        xx = F.layer_norm(x, (x.shape[-1],), weight=ln_w, bias=ln_b)
+        sx = sx - xx
+        xxx = xx + sx * x_maa
+        xxx = torch.tanh(xxx @ tm_w1).view(B, 5, -1).transpose(0, 1)
+        xxx = torch.bmm(xxx, tm_w2).view(5, B, -1)
+        mw, mk, mv, mr, mg = xxx.unbind(dim=0)
+
+        wx = xx + sx * (w_maa + mw)
+        kx = xx + sx * (k_maa + mk)
+        vx = xx + sx * (v_maa + mv)
+        rx = xx + sx * (r_maa + mr)
+        gx = xx + sx * (g_maa + mg)
+
+        r = matmul(rx, rw, rmx, rrx, rmy, rry, output_dtype=torch.float32).view(B, H, 1, N)
+        k = matmul(kx, kw, kmx, krx, kmy, kry, output_dtype=torch.float32).view(B, H, N, 1)
+        v = matmul(vx, vw, vmx, vrx, vmy, vry, output_dtype=torch.float32).view(B, H, 1, N)
+        g = F.silu(matmul(gx, gw, gmx, grx, gmy, gry))
+
+        w = t_decay + (torch.tanh(wx @ td_w1) @ td_w2).float().view(B, H, N, 1)
+
+        k = k * torch.clamp(w, max=0).exp()
+
+        w = torch.exp(-torch.exp(w.float()))
+        return xx, r, k, v, g, w
+
+    @MyFunction
+    def att_wkv_v6_0(self, x, xx, s, r, k, v, g, w, t_first, lx_w, lx_b, ow, omx, orx, omy, ory):
+        # WKV state update and output projection for B rows, on the values att_mix_v6_0 returns; s [B, H, N, N]
+        B = x.shape[0]
+        H = s.shape[1]
+
+        a = matmul(k, v)
+        out = r @ (t_first * a + s)
+        s = a + w * s
+
+        out = out.view(B, -1)
+        out = F.group_norm(out, num_groups=H, weight=lx_w, bias=lx_b, eps = 64e-5)
+        out = out.to(dtype=x.dtype) * g.to(dtype=x.dtype)
+        out = matmul(out, ow, omx, orx, omy, ory)
+
+        return x + out, xx, s
+
+    @MyFunction
+    def att_wkv_v6_0_inplace(self, x, xx, s, r, k, v, g, w, t_first, lx_w, lx_b, ow, omx, orx, omy, ory):
+        # att_wkv_v6_0 updating s in place (s * w + a) instead of returning a new state; returns the new x only
+        B = x.shape[0]
+        H = s.shape[1]
+
+        a = matmul(k, v)
+        out = r @ (t_first * a + s)
+        s.mul_(w).add_(a)
+
+        out = out.view(B, -1)
+        out = F.group_norm(out, num_groups=H, weight=lx_w, bias=lx_b, eps = 64e-5)
+        out = out.to(dtype=x.dtype) * g.to(dtype=x.dtype)
+        out = matmul(out, ow, omx, orx, omy, ory)
+
+        return x + out
+
+    @MyFunction
+    def att_batch_v6_0(self, x, sx, s, ln_w, ln_b, lx_w, lx_b, x_maa, w_maa, k_maa, v_maa, r_maa, g_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kw, vw, rw, gw, ow, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry, gmx, grx, gmy, gry, omx, orx, omy, ory):
+        # one token for each of B independent sequences: x/sx [B, C], s [B, H, N, N]
+        xx, r, k, v, g, w = self.att_mix_v6_0(x, sx, ln_w, ln_b, lx_w, lx_b, x_maa, w_maa, k_maa, v_maa, r_maa, g_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kw, vw, rw, gw, ow, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry, gmx, grx, gmy, gry, omx, orx, omy, ory)
+        return self.att_wkv_v6_0(x, xx, s, r, k, v, g, w, t_first, lx_w, lx_b, ow, omx, orx, omy, ory)
+
+    @MyFunction
+    def att_batch_v6_0_inplace(self, x, sx, s, ln_w, ln_b, lx_w, lx_b, x_maa, w_maa, k_maa, v_maa, r_maa, g_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kw, vw, rw, gw, ow, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry, gmx, grx, gmy, gry, omx, orx, omy, ory):
+        # att_batch_v6_0 with sx and s updated in place
+        xx, r, k, v, g, w = self.att_mix_v6_0(x, sx, ln_w, ln_b, lx_w, lx_b, x_maa, w_maa, k_maa, v_maa, r_maa, g_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kw, vw, rw, gw, ow, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry, gmx, grx, gmy, gry, omx, orx, omy, ory)
+        sx.copy_(xx)
+        return self.att_wkv_v6_0_inplace(x, xx, s, r, k, v, g, w, t_first, lx_w, lx_b, ow, omx, orx, omy, ory)
+
+    @MyFunction
+    def att_pair_v6_0(self, x, xx, s, row, t_first, lx_w, lx_b, ow, omx, orx, omy, ory):
+        # layer 0 from the pair table: row [B, 5C] holds r, k, v, g, w of (previous token, token), xx [B, C] the normed x
+        B = x.shape[0]
+        H = s.shape[1]
+        N = s.shape[-1]
+        r, k, v, g, w = row.view(B, 5, H, N).unbind(dim=1)
+        return self.att_wkv_v6_0(x, xx, s, r.view(B, H, 1, N), k.view(B, H, N, 1), v.view(B, H, 1, N), g.view(B, H * N), w.view(B, H, N, 1), t_first, lx_w, lx_b, ow, omx, orx, omy, ory)
+
+    @MyFunction
+    def att_pair_v6_0_inplace(self, x, xx, sx, s, row, t_first, lx_w, lx_b, ow, omx, orx, omy, ory):
+        # att_pair_v6_0 with sx and s updated in place
+        B = x.shape[0]
+        H = s.shape[1]
+        N = s.shape[-1]
+        r, k, v, g, w = row.view(B, 5, H, N).unbind(dim=1)
+        sx.copy_(xx)
+        return self.att_wkv_v6_0_inplace(x, xx, s, r.view(B, H, 1, N), k.view(B, H, N, 1), v.view(B, H, 1, N), g.view(B, H * N), w.view(B, H, N, 1), t_first, lx_w, lx_b, ow, omx, orx, omy, ory)
+
+    @MyFunction
+    def att_mix_v6_0_fused(self, x, sx, ln_w, ln_b, x_maa, wkvrg_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, kvrg_w):
+        # att_mix_v6_0 on fused weights: the five token-shift mixes as one [5, B, C] tensor (wkvrg_maa [5, C]),
+        # and k/v/r/g as one bmm with kvrg_w [4, C, C]
+        H = t_decay.shape[0]
+        N = x.shape[-1] // H
+        B = x.shape[0]
+
+        xx = F.layer_norm(x, (x.shape[-1],), weight=ln_w, bias=ln_b)
+        sx = sx - xx
+        xxx = xx + sx * x_maa
+        xxx = torch.tanh(xxx @ tm_w1).view(B, 5, -1).transpose(0, 1)
+        xxx = torch.bmm(xxx, tm_w2)
+        mixed = xx + sx * (wkvrg_maa.unsqueeze(1) + xxx)
+
+        k, v, r, g = matmul_float(mixed[1:], kvrg_w).unbind(dim=0)
+        r = r.float().view(B, H, 1, N)
+        k = k.float().view(B, H, N, 1)
+        v = v.float().view(B, H, 1, N)
+        g = F.silu(g)
+
+        w = t_decay + (torch.tanh(mixed[0] @ td_w1) @ td_w2).float().view(B, H, N, 1)
+
+        k = k * torch.clamp(w, max=0).exp()
+
+        w = torch.exp(-torch.exp(w.float()))
+        return xx, r, k, v, g, w
+
+    @MyFunction
+    def att_batch_v6_0_fused(self, x, sx, s, ln_w, ln_b, lx_w, lx_b, x_maa, wkvrg_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kvrg_w, ow, omx, orx, omy, ory):
+        xx, r, k, v, g, w = self.att_mix_v6_0_fused(x, sx, ln_w, ln_b, x_maa, wkvrg_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, kvrg_w)
+        return self.att_wkv_v6_0(x, xx, s, r, k, v, g, w, t_first, lx_w, lx_b, ow, omx, orx, omy, ory)
+
+    @MyFunction
+    def att_batch_v6_0_fused_inplace(self, x, sx, s, ln_w, ln_b, lx_w, lx_b, x_maa, wkvrg_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kvrg_w, ow, omx, orx, omy, ory):
+        # att_batch_v6_0_fused with sx and s updated in place
+        xx, r, k, v, g, w = self.att_mix_v6_0_fused(x, sx, ln_w, ln_b, x_maa, wkvrg_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, kvrg_w)
+        sx.copy_(xx)
+        return self.att_wkv_v6_0_inplace(x, xx, s, r, k, v, g, w, t_first, lx_w, lx_b, ow, omx, orx, omy, ory)
+
+    @MyFunction
+    def att_one_v6_0_fused(self, x, sx, s, ln_w, ln_b, lx_w, lx_b, x_maa, wkvrg_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kvrg_w, ow, omx, orx, omy, ory):
+        xx = F.layer_norm(x, (x.shape[-1],), weight=ln_w, bias=ln_b)
+
+        sx = sx - xx
+        xxx = xx + sx * x_maa
+        xxx = torch.tanh(xxx @ tm_w1).view(5, 1, -1)
+        xxx = torch.bmm(xxx, tm_w2).view(5, -1)
+        mixed = xx + sx * (wkvrg_maa + xxx)
+
+        H = t_decay.shape[0]
+        N = x.shape[-1] // H
+
+        k, v, r, g = matmul_float(mixed[1:].unsqueeze(1), kvrg_w).unbind(dim=0)
+        r = r.float().view(H, 1, N)
+        k = k.float().view(H, N, 1)
+        v = v.float().view(H, 1, N)
+        g = F.silu(g.view(-1))
+
+        w = t_decay + (torch.tanh(mixed[0] @ td_w1) @ td_w2).float().view(H, N, 1)
+
+        k = k * torch.clamp(w, max=0).exp()
+
+        w = torch.exp(-torch.exp(w.float()))
+
+        a = matmul(k, v)
+        out = r @ (t_first * a + s)
+        s = a + w * s
+
+        out = out.flatten()
+        out = F.group_norm(out.unsqueeze(0), num_groups=H, weight=lx_w, bias=lx_b, eps = 64e-5).squeeze(0)
+        out = out.to(dtype=x.dtype) * g
+        out = matmul(out, ow, omx, orx, omy, ory)
+
+        return x + out, xx, s
+
     ########################################################################################################
 
     if os.environ["RWKV_CUDA_ON"] == '1':
@@ -1001,7 +1518,7 @@ class RWKV(MyModule):
 
             return r, k, v, g, w, xx[-1,:], s.transpose(-1,-2).contiguous()
 
-        def cuda_att_seq_v6_0(self, x, sx, s, ln_w, ln_b, lx_w, lx_b, x_maa, w_maa, k_maa, v_maa, r_maa, g_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kw, vw, rw, gw, ow, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry, gmx, grx, gmy, gry, omx, orx, omy, ory):
+        def cuda_att_seq_v6_0(self, x, sx, s, ln_w, ln_b, lx_w, lx_b, x_maa, w_maa, k_maa, v_maa, r_maa, g_maa, tm_w1, tm_w2, td_w1, td_w2, t_decay, t_first, kw, vw, rw, gw, ow, kmx, krx, kmy, kry, vmx, vrx, vmy, vry, rmx, rrx, rmy, rry, gmx, grx, gmy, gry, omx, orx, omy, ory, chunk_len=0): # chunk_len is ignored, the kernel is already parallel
             H = t_decay.shape[0]
             N = x.shape[-1] // H
             T = x.shape[0]
@@ -1013,11 +1530,19 @@ class RWKV(MyModule):
 
     ########################################################################################################
 
-    def forward(self, tokens, state, full_output=False):
+    def tracks_prev(self, state):
+        # state made with the layer 0 pair table: v6 [att_xx, att_kv, ffn_xx] per layer plus the previous token id
+        # (a v4 state has 5 tensors per layer, so its length alone says nothing)
+        return self.version == 6.0 and self.l0_table is not None and len(state) == self.args.n_layer * 3 + 1
+
+    def forward(self, tokens, state, full_output=False, chunk_len=None):
+        # chunk_len (v6 seq mode only): None = automatic, 0 = per-token WKV loop, n = chunkwise WKV with chunks of n tokens
         with torch.no_grad():
-            w = self.w
             args = self.args
 
+            # layers are bound on first use: with JIT on, the script methods only exist once __init__ has returned
+            layers = getattr(self, 'layers', None) or self.bind_layers()
+
             if state == None:
                 if self.version == 4:
                     state = [None] * args.n_layer * 5
@@ -1038,213 +1563,275 @@ class RWKV(MyModule):
                         atype = dd.atype
                         state[i*3+0] = torch.zeros(args.n_embd, dtype=atype, requires_grad=False, device=dev).contiguous()
                         if args.time_state:
-                            state[i*3+1] = w[f'blocks.{i}.att.time_state'].transpose(1,2).to(dtype=torch.float, device=dev).requires_grad_(False).contiguous()
+                            state[i*3+1] = self.w[f'blocks.{i}.att.time_state'].transpose(1,2).to(dtype=torch.float, device=dev).requires_grad_(False).contiguous()
                         else:
                             state[i*3+1] = torch.zeros((args.n_head, args.n_att//args.n_head, args.n_att//args.n_head), dtype=torch.float, requires_grad=False, device=dev).contiguous()
                         state[i*3+2] = torch.zeros(args.n_embd, dtype=atype, requires_grad=False, device=dev).contiguous()
+                    if self.l0_table is not None:
+                        state.append(torch.tensor(self.emb.shape[0])) # previous token: none
 
             seq_mode = len(tokens) > 1
-
-            x = w['emb.weight'][tokens if seq_mode else tokens[0]]
-
-            for i in range(args.n_layer):
-                bbb = f'blocks.{i}.'
-                att = f'blocks.{i}.att.'
-                ffn = f'blocks.{i}.ffn.'
-                dd = self.strategy[i]
-                dev = dd.device
-                atype = dd.atype
-                wtype = dd.wtype
+            tracks_prev = self.tracks_prev(state)
+            if not seq_mode and getattr(self, 'step', None) is not None:
+                out, state = self.step(tokens[0], state)
+                if tracks_prev:
+                    state[-1] = torch.tensor(tokens[0])
+                return out, state
+
+            if seq_mode and chunk_len is None:
+                chunk_len = self.WKV_CHUNK_LEN if len(tokens) >= self.WKV_CHUNK_MIN_T else 0
+
+            x = self.emb[tokens if seq_mode else tokens[0]]
+            pair = None
+            if tracks_prev and not seq_mode:
+                pair = self.l0_table[int(state[-1]) * self.emb.shape[0] + tokens[0]]
+
+            for layer in layers:
+                x = x.to(dtype=layer.atype, device=layer.device)
+                att_w = layer.att_w if seq_mode else layer.att_one_w
+                ffn_w = layer.ffn_w
+                if layer.stream:
+                    att_w = [t.to(device=layer.device, non_blocking=True) for t in att_w]
+                    ffn_w = [t.to(device=layer.device, non_blocking=True) for t in ffn_w]
+
+                o = layer.state_offset
+                n = layer.n_state - 1
                 if seq_mode:
-                    cuda_applicable = os.environ["RWKV_CUDA_ON"] == '1' and 'cuda' in str(dev)
-                    if cuda_applicable:
-                        ATT = self.cuda_att_seq
+                    if layer.chunked:
+                        out = layer.att_seq(x, *state[o:o+n], *att_w, chunk_len)
                     else:
-                        ATT = self.att_seq
-                    if self.version == 5:
-                        ATT = self.att_seq_v5
-                    elif self.version == 5.1:
-                        ATT = self.att_seq_v5_1
-                    elif self.version == 5.2:
-                        ATT = self.att_seq_v5_2
-                        if cuda_applicable:
-                            ATT = self.cuda_att_seq_v5_2
-                    elif self.version == 6.0:
-                        ATT = self.att_seq_v6_0
-                        if cuda_applicable:
-                            ATT = self.cuda_att_seq_v6_0
-                    FFN = self.ffn_seq
-                    if self.version >= 6.0:
-                        FFN = self.ffn_seq_v6
-                else:
-                    ATT = self.att_one
-                    if self.version == 5:
-                        ATT = self.att_one_v5
-                    elif self.version == 5.1:
-                        ATT = self.att_one_v5_1
-                    elif self.version == 5.2:
-                        ATT = self.att_one_v5_1 # same as v5.1
-                    elif self.version == 6.0:
-                        ATT = self.att_one_v6_0
-                    FFN = self.ffn_one
-                    if self.version >= 6.0:
-                        FFN = self.ffn_one_v6
-
-                x = x.to(dtype=atype, device=dev)
-
-                kw = w[f'{att}key.weight']
-                vw = w[f'{att}value.weight']
-                rw = w[f'{att}receptance.weight']
-                ow = w[f'{att}output.weight']
-                if dd.stream:
-                    kw = kw.to(device=dev, non_blocking=True)
-                    vw = vw.to(device=dev, non_blocking=True)
-                    rw = rw.to(device=dev, non_blocking=True)
-                    ow = ow.to(device=dev, non_blocking=True)
-                kmx = w[f'{att}key.weight_mx'] if wtype == torch.uint8 else x
-                krx = w[f'{att}key.weight_rx'] if wtype == torch.uint8 else x
-                kmy = w[f'{att}key.weight_my'] if wtype == torch.uint8 else x
-                kry = w[f'{att}key.weight_ry'] if wtype == torch.uint8 else x
-                vmx = w[f'{att}value.weight_mx'] if wtype == torch.uint8 else x
-                vrx = w[f'{att}value.weight_rx'] if wtype == torch.uint8 else x
-                vmy = w[f'{att}value.weight_my'] if wtype == torch.uint8 else x
-                vry = w[f'{att}value.weight_ry'] if wtype == torch.uint8 else x
-                rmx = w[f'{att}receptance.weight_mx'] if wtype == torch.uint8 else x
-                rrx = w[f'{att}receptance.weight_rx'] if wtype == torch.uint8 else x
-                rmy = w[f'{att}receptance.weight_my'] if wtype == torch.uint8 else x
-                rry = w[f'{att}receptance.weight_ry'] if wtype == torch.uint8 else x
-                omx = w[f'{att}output.weight_mx'] if wtype == torch.uint8 else x
-                orx = w[f'{att}output.weight_rx'] if wtype == torch.uint8 else x
-                omy = w[f'{att}output.weight_my'] if wtype == torch.uint8 else x
-                ory = w[f'{att}output.weight_ry'] if wtype == torch.uint8 else x
-                if self.version in [5.1, 5.2, 6.0]:
-                    gw = w[f'{att}gate.weight']
-                    if dd.stream:
-                        gw = gw.to(device=dev, non_blocking=True)
-                    gmx = w[f'{att}gate.weight_mx'] if wtype == torch.uint8 else x
-                    grx = w[f'{att}gate.weight_rx'] if wtype == torch.uint8 else x
-                    gmy = w[f'{att}gate.weight_my'] if wtype == torch.uint8 else x
-                    gry = w[f'{att}gate.weight_ry'] if wtype == torch.uint8 else x
-                if self.version == 4:
-                    x, state[i*5+0], state[i*5+1], state[i*5+2], state[i*5+3] = ATT(
-                        x, state[i*5+0], state[i*5+1], state[i*5+2], state[i*5+3],
-                        w[f'{bbb}ln1.weight'], w[f'{bbb}ln1.bias'],
-                        w[f'{att}time_mix_k'], w[f'{att}time_mix_v'], w[f'{att}time_mix_r'],
-                        w[f'{att}time_decay'], w[f'{att}time_first'],
-                        kw, vw, rw, ow,
-                        kmx, krx, kmy, kry,
-                        vmx, vrx, vmy, vry,
-                        rmx, rrx, rmy, rry,
-                        omx, orx, omy, ory,
-                        )
-                elif self.version == 5:
-                    x, state[i*3+0], state[i*3+1] = ATT(
-                        x, state[i*3+0], state[i*3+1],
-                        w[f'{bbb}ln1.weight'], w[f'{bbb}ln1.bias'],
-                        w[f'{att}ln_x.weight'], w[f'{att}ln_x.bias'],
-                        w[f'{att}time_mix_k'], w[f'{att}time_mix_v'], w[f'{att}time_mix_r'],
-                        w[f'{att}time_decay'], w[f'{att}time_first'],
-                        kw, vw, rw, ow,
-                        kmx, krx, kmy, kry,
-                        vmx, vrx, vmy, vry,
-                        rmx, rrx, rmy, rry,
-                        omx, orx, omy, ory,
-                        )
-                elif self.version in [5.1, 5.2]:
-                    x, state[i*3+0], state[i*3+1] = ATT(
-                        x, state[i*3+0], state[i*3+1],
-                        w[f'{bbb}ln1.weight'], w[f'{bbb}ln1.bias'],
-                        w[f'{att}ln_x.weight'], w[f'{att}ln_x.bias'],
-                        w[f'{att}time_mix_k'], w[f'{att}time_mix_v'], w[f'{att}time_mix_r'], w[f'{att}time_mix_g'],
-                        w[f'{att}time_decay'], w[f'{att}time_first'],
-                        kw, vw, rw, gw, ow,
-                        kmx, krx, kmy, kry,
-                        vmx, vrx, vmy, vry,
-                        rmx, rrx, rmy, rry,
-                        gmx, grx, gmy, gry,
-                        omx, orx, omy, ory,
-                        )
-                elif self.version == 6.0:
-                    x, state[i*3+0], state[i*3+1] = ATT(
-                        x, state[i*3+0], state[i*3+1],
-                        w[f'{bbb}ln1.weight'], w[f'{bbb}ln1.bias'],
-                        w[f'{att}ln_x.weight'], w[f'{att}ln_x.bias'],
-                        w[f'{att}time_maa_x'], w[f'{att}time_maa_w'], w[f'{att}time_maa_k'], w[f'{att}time_maa_v'], w[f'{att}time_maa_r'], w[f'{att}time_maa_g'],
-                        w[f'{att}time_maa_w1'], w[f'{att}time_maa_w2'], w[f'{att}time_decay_w1'], w[f'{att}time_decay_w2'],
-                        w[f'{att}time_decay'], w[f'{att}time_first'],
-                        kw, vw, rw, gw, ow,
-                        kmx, krx, kmy, kry,
-                        vmx, vrx, vmy, vry,
-                        rmx, rrx, rmy, rry,
-                        gmx, grx, gmy, gry,
-                        omx, orx, omy, ory,
-                        )
-                if dd.stream:
-                    del kw, vw, rw, ow
-                    if self.version in [5.1, 5.2, 6.0]:
-                        del gw
-
-                kw = w[f'{ffn}key.weight']
-                vw = w[f'{ffn}value.weight']
-                rw = w[f'{ffn}receptance.weight']
-                if dd.stream:
-                    kw = kw.to(device=dev, non_blocking=True)
-                    vw = vw.to(device=dev, non_blocking=True)
-                    rw = rw.to(device=dev, non_blocking=True)
-                kmx = w[f'{ffn}key.weight_mx'] if wtype == torch.uint8 else x
-                krx = w[f'{ffn}key.weight_rx'] if wtype == torch.uint8 else x
-                kmy = w[f'{ffn}key.weight_my'] if wtype == torch.uint8 else x
-                kry = w[f'{ffn}key.weight_ry'] if wtype == torch.uint8 else x
-                vmx = w[f'{ffn}value.weight_mx'] if wtype == torch.uint8 else x
-                vrx = w[f'{ffn}value.weight_rx'] if wtype == torch.uint8 else x
-                vmy = w[f'{ffn}value.weight_my'] if wtype == torch.uint8 else x
-                vry = w[f'{ffn}value.weight_ry'] if wtype == torch.uint8 else x
-                rmx = w[f'{ffn}receptance.weight_mx'] if wtype == torch.uint8 else x
-                rrx = w[f'{ffn}receptance.weight_rx'] if wtype == torch.uint8 else x
-                rmy = w[f'{ffn}receptance.weight_my'] if wtype == torch.uint8 else x
-                rry = w[f'{ffn}receptance.weight_ry'] if wtype == torch.uint8 else x
-                if self.version == 4:
-                    offset = i*5+4
-                elif int(self.version) in [5,6]:
-                    offset = i*3+2
-                if self.version < 6.0:
-                    x, state[offset] = FFN(
-                        x, state[offset],
-                        w[f'{bbb}ln2.weight'], w[f'{bbb}ln2.bias'],
-                        w[f'{ffn}time_mix_k'], w[f'{ffn}time_mix_r'],
-                        kw, vw, rw,
-                        kmx, krx, kmy, kry,
-                        vmx, vrx, vmy, vry,
-                        rmx, rrx, rmy, rry,                    
-                        )
+                        out = layer.att_seq(x, *state[o:o+n], *att_w)
+                    x = out[0]
+                    state[o:o+n] = out[1:]
+                    x, state[o+n] = layer.ffn_seq(x, state[o+n], *ffn_w)
                 else:
-                    x, state[offset] = FFN(
-                        x, state[offset],
-                        w[f'{bbb}ln2.weight'], w[f'{bbb}ln2.bias'],
-                        w[f'{ffn}time_maa_k'], w[f'{ffn}time_maa_r'],
-                        kw, vw, rw,
-                        kmx, krx, kmy, kry,
-                        vmx, vrx, vmy, vry,
-                        rmx, rrx, rmy, rry,                    
-                        )
-                if dd.stream:                
-                    del kw, vw, rw
-                
-                if self.RESCALE_LAYER > 0:
-                    if (i+1) % self.RESCALE_LAYER == 0:
-                        x = x / 2
+                    if pair is not None: # layer 0 from the pair table
+                        x, xx, s = self.att_pair_v6_0(x.unsqueeze(0), self.l0_xx[tokens[0]].unsqueeze(0), state[o+1].unsqueeze(0), pair.unsqueeze(0), *self.l0_pair_w)
+                        out = (x.squeeze(0), xx.squeeze(0), s.squeeze(0))
+                        pair = None
+                    else:
+                        out = layer.att_one(x, *state[o:o+n], *att_w)
+                    x = out[0]
+                    state[o:o+n] = out[1:]
+                    x, state[o+n] = layer.ffn_one(x, state[o+n], *ffn_w)
+                del att_w, ffn_w
+
+                if layer.rescale:
+                    x = x / 2
             
+            if tracks_prev:
+                state[-1] = torch.tensor(tokens[-1])
+
             dd = self.strategy[args.n_layer]
             x = x[-1,:] if (seq_mode and (not full_output)) else x
             x = x.to(dtype=dd.atype, device=dd.device)
             
-            x = F.layer_norm(x, (args.n_embd,), weight=w['ln_out.weight'], bias=w['ln_out.bias'])
-            if w['head.weight'].dtype != torch.uint8:
-                x = x @ w['head.weight']
+            return self.head(x).float(), state
+
+    def compile_step(self, save=True):
+        # optional whole-step executor for v6 single-token forward: one frozen TorchScript graph for embedding,
+        # all blocks and head (see StepV6); saved next to the model and reloaded later, so compilation happens once
+        if self.version != 6.0 or any(dd.stream for dd in self.strategy) or len(set(str(dd.device) for dd in self.strategy)) > 1:
+            raise NotImplementedError('compile_step needs a v6 model on a single device without streaming')
+        path = self.args.MODEL_NAME[:-4] + f'.{self.args.snapshot_tag}.step{StepV6.VERSION}.pt'
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(self.args.MODEL_NAME):
+            step = torch.jit.load(path, map_location=self.strategy[0].device)
+        else:
+            step = torch.jit.freeze(torch.jit.script(StepV6(self).eval()))
+            if save:
+                tmp = f'{path}.{os.getpid()}.tmp'
+                torch.jit.save(step, tmp)
+                os.replace(tmp, path)
+        self.step = step.forward # the bound method, a submodule can't be added to a ScriptModule after __init__
+        return step
+
+    def head(self, x):
+        ln_w, ln_b, hw = self.head_w[:3]
+        x = F.layer_norm(x, (self.args.n_embd,), weight=ln_w, bias=ln_b)
+        if hw.dtype == torch.int8:
+            return torch_mm8_int(x, hw, *self.head_w[3:])
+        if hw.dtype != torch.uint8:
+            return x @ hw
+        if len(x.shape) == 2:
+            return mm8_seq(x, hw, *self.head_w[3:])
+        return mm8_one(x, hw, *self.head_w[3:])
+
+    ########################################################################################################
+
+    def zero_state_batch(self, B):
+        # batched v6 state: 0=att_xx [B, C] 1=att_kv [B, H, N, N] 2=ffn_xx [B, C] (+ previous token ids [B] with the pair table)
+        args = self.args
+        if not getattr(self, 'layers', None):
+            self.bind_layers() # sets l0_table
+        N = args.n_att // args.n_head
+        state = [None] * args.n_layer * 3
+        for i in range(args.n_layer):
+            dd = self.strategy[i]
+            state[i*3+0] = torch.zeros((B, args.n_embd), dtype=dd.atype, requires_grad=False, device=dd.device).contiguous()
+            if args.time_state:
+                state[i*3+1] = self.w[f'blocks.{i}.att.time_state'].transpose(1,2).to(dtype=torch.float, device=dd.device).unsqueeze(0).repeat(B, 1, 1, 1).contiguous()
             else:
-                if seq_mode and full_output:
-                    x = mm8_seq(x, w['head.weight'], w['head.weight_mx'], w['head.weight_rx'], w['head.weight_my'], w['head.weight_ry'])
+                state[i*3+1] = torch.zeros((B, args.n_head, N, N), dtype=torch.float, requires_grad=False, device=dd.device).contiguous()
+            state[i*3+2] = torch.zeros((B, args.n_embd), dtype=dd.atype, requires_grad=False, device=dd.device).contiguous()
+        if self.l0_table is not None:
+            state.append(torch.full((B,), self.emb.shape[0], dtype=torch.long))
+        return state
+
+    def stack_states(self, states):
+        # list of per-sequence states (as returned by forward) -> one batched state
+        return [torch.stack([s[j] for s in states]).contiguous() for j in range(len(states[0]))]
+
+    def unstack_state(self, state, b):
+        # batched state -> per-sequence state of row b, usable with forward
+        return [s[b].clone() for s in state]
+
+    def forward_batch(self, tokens, state, inplace=False):
+        # advance B independent sequences by one token each: tokens [B], state from zero_state_batch / stack_states
+        # inplace: write the new state into the given tensors (e.g. views of a StateArena) instead of new ones
+        if self.version != 6.0:
+            raise NotImplementedError('forward_batch only supports RWKV v6 models')
+        with torch.no_grad():
+            args = self.args
+            layers = getattr(self, 'layers', None) or self.bind_layers()
+
+            if not torch.is_tensor(tokens):
+                tokens = torch.tensor(tokens, dtype=torch.long)
+            if state == None:
+                state = self.zero_state_batch(tokens.shape[0])
+
+            x = self.emb[tokens]
+            tracks_prev = self.tracks_prev(state)
+            pair = None
+            if tracks_prev:
+                pair = self.l0_table[state[-1] * self.emb.shape[0] + tokens]
+
+            for layer in layers:
+                x = x.to(dtype=layer.atype, device=layer.device)
+                att_w = layer.att_one_w
+                ffn_w = layer.ffn_w
+                if layer.stream:
+                    att_w = [t.to(device=layer.device, non_blocking=True) for t in att_w]
+                    ffn_w = [t.to(device=layer.device, non_blocking=True) for t in ffn_w]
+
+                o = layer.state_offset
+                if pair is not None and inplace: # layer 0 from the pair table
+                    x = self.att_pair_v6_0_inplace(x, self.l0_xx[tokens], state[o], state[o+1], pair, *self.l0_pair_w)
+                elif pair is not None:
+                    x, state[o], state[o+1] = self.att_pair_v6_0(x, self.l0_xx[tokens], state[o+1], pair, *self.l0_pair_w)
+                elif inplace:
+                    x = layer.att_batch_inplace(x, state[o], state[o+1], *att_w)
+                else:
+                    x, state[o], state[o+1] = layer.att_batch(x, state[o], state[o+1], *att_w)
+                pair = None
+                # ffn_one_v6 is row-wise, so it already handles [B, C]
+                x, xx = layer.ffn_one(x, state[o+2], *ffn_w)
+                if inplace:
+                    state[o+2].copy_(xx)
+                else:
+                    state[o+2] = xx
+                del att_w, ffn_w
+
+                if layer.rescale:
+                    x = x / 2
+
+            if tracks_prev:
+                if inplace:
+                    state[-1].copy_(tokens)
                 else:
-                    x = mm8_one(x, w['head.weight'], w['head.weight_mx'], w['head.weight_rx'], w['head.weight_my'], w['head.weight_ry'])
+                    state[-1] = tokens.clone()
 
-            return x.float(), state
\ No newline at end of file
+            dd = self.strategy[args.n_layer]
+            x = x.to(dtype=dd.atype, device=dd.device)
+
+            return self.head(x).float(), state
+
+########################################################################################################
+
+class BlockV6(nn.Module):
+    # one v6 block (att_one_v6_0 + ffn_one_v6) with its weights as attributes, for StepV6
+    ATT = V6_ATT_W
+    FFN = ['ln2_w', 'ln2_b', 'fk_maa', 'fr_maa', 'fkw', 'fvw', 'frw', 'fkmx', 'fkrx', 'fkmy', 'fkry', 'fvmx', 'fvrx', 'fvmy', 'fvry', 'frmx', 'frrx', 'frmy', 'frry']
+
+    def __init__(self, layer):
+        super().__init__()
+        for name, t in zip(self.ATT, layer.att_w):
+            self.register_buffer(name, t)
+        for name, t in zip(self.FFN, layer.ffn_w):
+            self.register_buffer(name, t)
+        self.rescale = layer.rescale
+
+    def forward(self, x, sx, s, fx):
+        xx = F.layer_norm(x, (x.shape[-1],), weight=self.ln1_w, bias=self.ln1_b)
+        sx = sx - xx
+        xxx = xx + sx * self.x_maa
+        xxx = torch.tanh(xxx @ self.tm_w1).view(5, 1, -1)
+        xxx = torch.bmm(xxx, self.tm_w2).view(5, -1)
+        mw, mk, mv, mr, mg = xxx.unbind(dim=0)
+
+        wx = xx + sx * (self.w_maa + mw)
+        kx = xx + sx * (self.k_maa + mk)
+        vx = xx + sx * (self.v_maa + mv)
+        rx = xx + sx * (self.r_maa + mr)
+        gx = xx + sx * (self.g_maa + mg)
+
+        H = self.t_decay.shape[0]
+        N = x.shape[-1] // H
+
+        r = matmul(rx, self.arw, self.armx, self.arrx, self.army, self.arry, output_dtype=torch.float32).view(H, 1, N)
+        k = matmul(kx, self.akw, self.akmx, self.akrx, self.akmy, self.akry, output_dtype=torch.float32).view(H, N, 1)
+        v = matmul(vx, self.avw, self.avmx, self.avrx, self.avmy, self.avry, output_dtype=torch.float32).view(H, 1, N)
+        g = F.silu(matmul(gx, self.agw, self.agmx, self.agrx, self.agmy, self.agry))
+
+        w = self.t_decay + (torch.tanh(wx @ self.td_w1) @ self.td_w2).float().view(H, N, 1)
+        k = k * torch.clamp(w, max=0).exp()
+        w = torch.exp(-torch.exp(w.float()))
+
+        a = matmul(k, v)
+        out = r @ (self.t_first * a + s)
+        s = a + w * s
+
+        out = out.flatten()
+        out = F.group_norm(out.unsqueeze(0), num_groups=H, weight=self.lx_w, bias=self.lx_b, eps = 64e-5).squeeze(0)
+        out = out.to(dtype=x.dtype) * g
+        x = x + matmul(out, self.aow, self.aomx, self.aorx, self.aomy, self.aory)
+
+        xf = F.layer_norm(x, (x.shape[-1],), weight=self.ln2_w, bias=self.ln2_b)
+        fs = fx - xf
+        kx = xf + fs * self.fk_maa
+        rx = xf + fs * self.fr_maa
+        r = torch.sigmoid(matmul(rx, self.frw, self.frmx, self.frrx, self.frmy, self.frry))
+        vx = torch.relu(matmul(kx, self.fkw, self.fkmx, self.fkrx, self.fkmy, self.fkry)) ** 2
+        x = x + r * matmul(vx, self.fvw, self.fvmx, self.fvrx, self.fvmy, self.fvry)
+
+        if self.rescale:
+            x = x / 2
+        return x, xx, s, xf
+
+class StepV6(nn.Module):
+    # the whole single-token v6 step (embedding, blocks, ln_out, head) as one module, so it can be scripted and
+    # frozen into a single graph; state is the same list as RWKV.forward uses: [att_xx, att_kv, ffn_xx] per layer
+    VERSION = 1 # bump when the graph changes, saved executors are keyed by it
+
+    def __init__(self, model):
+        super().__init__()
+        layers = getattr(model, 'layers', None) or model.bind_layers()
+        self.blocks = nn.ModuleList([BlockV6(layer) for layer in layers])
+        self.register_buffer('emb', model.emb)
+        self.register_buffer('ln_out_w', model.head_w[0])
+        self.register_buffer('ln_out_b', model.head_w[1])
+        self.register_buffer('head_w', model.head_w[2])
+        none = torch.empty(0, dtype=model.head_w[0].dtype, device=model.head_w[0].device)
+        mm = model.head_w[3:] if len(model.head_w) > 3 else (none, none, none, none)
+        self.register_buffer('head_mx', mm[0])
+        self.register_buffer('head_rx', mm[1])
+        self.register_buffer('head_my', mm[2])
+        self.register_buffer('head_ry', mm[3])
+
+    def forward(self, token: int, state: List[torch.Tensor]) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        x = self.emb[token]
+        i = 0
+        for block in self.blocks:
+            x, state[i], state[i+1], state[i+2] = block(x, state[i], state[i+1], state[i+2])
+            i += 3
+        x = F.layer_norm(x, (x.shape[-1],), weight=self.ln_out_w, bias=self.ln_out_b)
+        return matmul(x, self.head_w, self.head_mx, self.head_rx, self.head_my, self.head_ry).float(), state
@@ -0,0 +1,370 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_solve(request):
+    """
+    Check a /solve body and return (puzzle, max_tokens, deadline_s); raises ValueError with a message for the client
+    """
+    import tools
+
+    if not isinstance(request, dict) or not isinstance(request.get("puzzle"), list):
+        raise ValueError('body must be an object with a "puzzle" list')
+    cells = [n for row in request["puzzle"] for n in (row if isinstance(row, list) else [row])]
+    if sorted(n for n in cells if type(n) is int) != list(range(16)):
+        raise ValueError("puzzle must hold the numbers 0-15 once")
+    puzzle = [cells[i : i + 4] for i in range(0, 16, 4)]
+    if not tools.is_solvable(puzzle):
+        raise ValueError("puzzle is not solvable")
+    max_tokens = request.get("max_tokens")
+    if max_tokens is not None and (type(max_tokens) is not int or max_tokens <= 0):
+        raise ValueError("max_tokens must be a positive integer")
+    deadline_s = request.get("deadline_s")
+    if deadline_s is not None and (type(deadline_s) not in (int, float) or not deadline_s >= 0):
+        raise ValueError("deadline_s must be a number >= 0")
+    return puzzle, max_tokens, deadline_s
+
+
+class Session:
+    """
+    One board being solved: its arena slot, the logits for its next id and what it has produced so far
+    Args:
+        max_tokens: id budget
+        deadline: time.monotonic() value, the session ends with status "deadline" at the first step after it
+        predicted: puzzle_trace.trace_length(puzzle) if already known
+    """
+
+    def __init__(self, puzzle, fsm, max_tokens=None, deadline=None, predicted=None):
+        import puzzle_trace
+
+        self.id = None
+        self.puzzle = puzzle
+        self.max_tokens = max_tokens
+        self.deadline = deadline
+        # ids of the solver trace, what a correct run decodes; the server computes it off the event loop and passes it in
+        self.predicted = puzzle_trace.trace_length(puzzle) if predicted is None else predicted
+        self.events = asyncio.Queue()  # dicts streamed to the client, the last one has "done"
+        self.slot = None
+        self.out = None
+        self.g = fsm.start if fsm is not None else None
+        self.tracker = puzzle_trace.TraceTracker(puzzle)
+        self.prev = None
+        self.pending = None  # direction of a "> Move" line not yet ended by its newline
+        self.tokens = 0
+        self.moves = []  # output moves
+        self.cancelled = None  # reason once cancelled: "cancelled" (POST /cancel) or "disconnected"
+        self.t0 = time.perf_counter()
+
+    def stopped(self, now):
+        """Why the session must end before its next id (cancellation, deadline), or None"""
+        if self.cancelled:
+            return self.cancelled
+        if self.deadline is not None and now >= self.deadline:
+            return "deadline"
+        return None
+
+
+class SolveServer:
+    """
+    Local solve server with continuous batching
+
+    One scheduler task owns the model. Every tick it admits queued boards into free StateArena slots (prompt state from
+    a StateCache), picks the next id of every active session (argmax over the trace grammar), and advances them all with
+    one batched forward. As in Generator.generate_ids, the ids that are fully determined after it (the board echoed
+    after a move, a position where the grammar allows one id) are appended without decoding; a session with such ids
+    runs them in one seq forward of its own that tick, so the output is the same as solving the board alone.
+    Model work runs in a single worker thread so the event loop keeps serving connections.
+    Moves are streamed once their "> Move" line is complete and legal; sessions end on the stop token, on the first invalid move or board
+    (puzzle_trace.TraceTracker.error), after their id budget, at their deadline or when cancelled; a stopped session
+    gives its slot back before the next admission. When max_queue boards are waiting, new ones get 503.
+    With schedule="sjf" the queue is ordered by predicted length (puzzle_trace.trace_length), shortest first, which
+    cuts mean latency when lengths vary; "fifo" keeps arrival order. A steady stream of short boards can delay long
+    ones under "sjf".
+    """
+
+    def __init__(self, model, max_batch=32, max_queue=256, token_count=20000, constrained=True, schedule="sjf"):
+        import grammar
+        from state_arena import StateArena
+        from state_cache import StateCache
+
+        self.model = model
+        self.arena = StateArena(model, max_batch)
+        self.cache = StateCache(model)
+        self.fsm = grammar.get_grammar() if constrained else None
+        self.max_batch = max_batch
+        self.token_count = token_count
+        self.schedule = schedule
+        self.queue = asyncio.PriorityQueue(max_queue)  # (priority, arrival, session)
+        self.arrivals = itertools.count()
+        self.active = []
+        self.sessions = {}  # id -> session, until it is done
+        self.executor = ThreadPoolExecutor(1)
+        self.started = time.perf_counter()
+        self.counters = {"admitted": 0, "rejected": 0, "completed": 0, "solved": 0, "cancelled": 0, "deadline": 0, "tokens": 0, "forced": 0, "steps": 0, "busy_s": 0.0, "predicted_tokens": 0, "actual_tokens": 0, "prediction_error": 0}
+
+    def metrics(self):
+        c = self.counters
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_max": self.queue.maxsize,
+            "active": len(self.active),
+            "max_batch": self.max_batch,
+            **{k: round(v, 3) if isinstance(v, float) else v for k, v in c.items()},
+            "mean_batch": round(c["tokens"] / c["steps"], 2) if c["steps"] else 0,
+            "mean_prediction_error": round(c["prediction_error"] / c["completed"], 1) if c["completed"] else 0,
+            "tok_s": round((c["tokens"] + c["forced"]) / c["busy_s"], 1) if c["busy_s"] else 0,
+            "uptime_s": round(time.perf_counter() - self.started, 1),
+        }
+
+    # ---------------------------------------------------------------- scheduler (model work in the worker thread)
+
+    def step(self, admit):
+        """Admit new sessions, advance all active ones by one decoded id (plus forced ids); returns (session, event) pairs to deliver"""
+        import torch
+        from puzzle_trace import OUTPUT_END
+
+        t0 = time.perf_counter()
+        now = time.monotonic()
+        events = []
+        live = []
+        for s in self.active:  # stopped sessions free their slots before the new ones take theirs
+            reason = s.stopped(now)
+            if reason:
+                self.finish(s, reason, events)
+            else:
+                live.append(s)
+        for s in admit:
+            s.out, state = self.cache.prefill(s.puzzle)
+            s.slot = self.arena.acquire(state)
+            live.append(s)
+        self.active = live
+
+        if live:
+            logits = torch.stack([s.out for s in live])
+            if self.fsm is not None:
+                logits = logits + self.fsm.mask[[s.g for s in live]]
+            tokens = logits.argmax(dim=-1).tolist()
+
+            advance = []
+            for s, token in zip(live, tokens):
+                # like Generator.generate_ids: ids that are fully determined (board echo, single legal id) follow at once
+                budget = min(s.max_tokens or self.token_count, self.token_count)
+                new = fed = [token]
+                while True:
+                    fed = self.feed(s, fed, events)
+                    if OUTPUT_END in new or not fed or s.tokens >= budget:
+                        break
+                    fed = fed[: budget - s.tokens]
+                    new = new + fed
+
+                status = None
+                if OUTPUT_END in new:
+                    status = "solved" if s.tracker.solved() else "unsolved"
+                elif s.tracker.error:
+                    status = s.tracker.error
+                elif self.fsm is not None and s.g is None:
+                    status = "format"
+                elif s.tokens >= budget:
+                    status = "budget"
+                if status is None:
+                    advance.append((s, new))
+                else:
+                    self.finish(s, status, events)
+
+            single = [(s, new) for s, new in advance if len(new) == 1]
+            if single:
+                out = self.arena.forward_batch([new[0] for _, new in single], [s.slot for s, _ in single])
+                for i, (s, _) in enumerate(single):
+                    s.out = out[i]
+            for s, new in advance:
+                if len(new) > 1:  # forced ids: one seq forward for this session
+                    s.out = self.arena.forward(new, s.slot)
+            if advance:
+                self.counters["tokens"] += len(advance)
+                self.counters["forced"] += sum(len(new) - 1 for _, new in advance)
+                self.counters["steps"] += 1
+
+            self.active = [s for s, _ in advance]
+        self.counters["busy_s"] += time.perf_counter() - t0
+        return events
+
+    def feed(self, s, tokens, events):
+        """
+        Move a session over new ids: grammar state, TraceTracker, output moves and streamed "> Move" lines
+        Returns:
+            The ids that must follow (Generator.advance)
+        """
+        from puzzle_trace import MOVE, NEWLINE, TOKEN_DIRECTION
+
+        forced = []
+        for token in tokens:
+            s.tokens += 1
+            s.g = self.fsm.next[s.g].get(token) if self.fsm is not None and s.g is not None else None
+            forced = s.tracker.feed([token])
+            if s.tracker.answer is not None and token in TOKEN_DIRECTION:
+                s.moves.append(TOKEN_DIRECTION[token])
+            elif s.prev == MOVE and token in TOKEN_DIRECTION:
+                s.pending = TOKEN_DIRECTION[token]
+            elif token == NEWLINE and s.pending is not None:
+                if not s.tracker.error:  # the tracker has played it on the board
+                    events.append((s, {"move": s.pending}))
+                s.pending = None
+            s.prev = token
+        if not forced and self.fsm is not None and s.g is not None and self.fsm.forced[s.g] >= 0:
+            forced = [self.fsm.forced[s.g]]
+        return forced
+
+    def finish(self, s, status, events):
+        # frees the slot (if any) and queues the done event; status: solved / unsolved / an error / budget / cancelled...
+        if s.slot is not None:
+            self.arena.release(s.slot)
+            s.slot = None
+        c = self.counters
+        c["completed"] += 1
+        c["solved"] += status == "solved"
+        c["cancelled"] += status in ("cancelled", "disconnected")
+        c["deadline"] += status == "deadline"
+        if s.tokens:
+            c["predicted_tokens"] += s.predicted
+            c["actual_tokens"] += s.tokens
+            c["prediction_error"] += abs(s.tokens - s.predicted)
+        events.append((s, {"done": True, "status": status, "solution": s.moves, "tokens": s.tokens, "predicted_tokens": s.predicted, "seconds": round(time.perf_counter() - s.t0, 3)}))
+
+    async def scheduler(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            admit, events = [], []
+            if not self.active:
+                admit.append((await self.queue.get())[-1])  # idle until the first board arrives
+            now = time.monotonic()
+            running = sum(s.stopped(now) is None for s in self.active)
+            while running + len(admit) < self.max_batch and not self.queue.empty():
+                admit.append(self.queue.get_nowait()[-1])
+            for s in [s for s in admit if s.stopped(now)]:  # cancelled or expired while queued, never gets a slot
+                admit.remove(s)
+                self.finish(s, s.stopped(now), events)
+            self.counters["admitted"] += len(admit)
+            if admit or self.active:
+                events += await loop.run_in_executor(self.executor, self.step, admit)
+            for s, event in events:
+                if event.get("done"):
+                    self.sessions.pop(s.id, None)
+                s.events.put_nowait(event)
+
+    # ---------------------------------------------------------------- HTTP
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            method, path = request.decode("latin-1").split()[:2]
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            body = await reader.readexactly(length) if length else b""
+
+            if method == "GET" and path == "/metrics":
+                await self.respond(writer, 200, self.metrics())
+            elif method == "POST" and path == "/solve":
+                await self.solve(writer, body)
+            elif method == "POST" and path == "/cancel":
+                request = json.loads(body)
+                if not isinstance(request, dict) or type(request.get("id")) is not int:
+                    raise ValueError("no session id")
+                session = self.sessions.get(request["id"])
+                if session is not None:
+                    session.cancelled = "cancelled"
+                await self.respond(writer, 200, {"cancelled": session is not None})
+            else:
+                await self.respond(writer, 404, {"error": "not found"})
+        except (ValueError, asyncio.IncompleteReadError):
+            await self.respond(writer, 400, {"error": "bad request"})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, code, obj):
+        body = json.dumps(obj).encode()
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 503: "Service Unavailable"}[code]
+        writer.write(f"HTTP/1.1 {code} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def solve(self, writer, body):
+        import puzzle_trace
+
+        try:
+            puzzle, max_tokens, deadline_s = parse_solve(json.loads(body))
+        except ValueError as e:
+            await self.respond(writer, 400, {"error": str(e)})
+            return
+        deadline = time.monotonic() + deadline_s if deadline_s is not None else None
+        # runs the solver (1-2 ms), so not on the event loop; the default pool, not the model's worker thread
+        predicted = await asyncio.get_running_loop().run_in_executor(None, puzzle_trace.trace_length, puzzle)
+        session = Session(puzzle, self.fsm, max_tokens, deadline, predicted)
+        session.id = next(self.arrivals)
+        try:
+            self.queue.put_nowait((session.predicted if self.schedule == "sjf" else 0, session.id, session))
+        except asyncio.QueueFull:
+            self.counters["rejected"] += 1
+            await self.respond(writer, 503, {"error": "busy", "queue_depth": self.queue.qsize()})
+            return
+        self.sessions[session.id] = session
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n")
+        writer.write(json.dumps({"id": session.id, "predicted_tokens": session.predicted}).encode() + b"\n")
+        try:
+            while True:
+                event = await session.events.get()
+                writer.write(json.dumps(event).encode() + b"\n")
+                await writer.drain()
+                if event.get("done"):
+                    break
+        except ConnectionError:
+            session.cancelled = "disconnected"  # the scheduler frees its slot on the next tick
+            raise
+
+
+async def serve(server, host="127.0.0.1", port=8015, unix=None):
+    if unix:
+        listener = await asyncio.start_unix_server(server.handle, path=unix)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+    print(f"solve server on {unix or f'http://{host}:{port}'} (POST /solve, GET /metrics)", flush=True)
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), server.scheduler())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local 15-puzzle solve server with continuous batching")
+    parser.add_argument("--model", default="rwkv_15puzzle_20241214.pth")
+    parser.add_argument("--strategy", default="cpu fp32")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8015)
+    parser.add_argument("--unix", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--max-batch", type=int, default=32, help="sessions decoded together")
+    parser.add_argument("--max-queue", type=int, default=256, help="boards waiting for a slot before requests get 503")
+    parser.add_argument("--token-count", type=int, default=20000, help="id budget per board")
+    parser.add_argument("--schedule", choices=["sjf", "fifo"], default="sjf", help="admission order: shortest predicted trace first, or arrival")
+    args = parser.parse_args()
+
+    os.environ.setdefault("RWKV_JIT_ON", "1")
+    os.environ.setdefault("RWKV_CUDA_ON", "0")
+    from rwkv_model import RWKV
+
+    model = RWKV(model=args.model, strategy=args.strategy, verbose=False)
+    server = SolveServer(model, max_batch=args.max_batch, max_queue=args.max_queue, token_count=args.token_count, schedule=args.schedule)
+    asyncio.run(serve(server, args.host, args.port, args.unix))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+
+
+def read_boards(lines):
+    """
+    Yields (id, puzzle) per non-empty JSONL line: {"id": ..., "puzzle": board} or a bare board, where a board is a 4x4
+    list or 16 numbers. id defaults to the line number (from 0); puzzle is None if the line is not a valid board.
+    """
+    for n, line in enumerate(lines):
+        if not line.strip():
+            continue
+        key, puzzle = n, None
+        try:
+            obj = json.loads(line)
+            if isinstance(obj, dict):
+                key = obj.get("id", n)
+                obj = obj.get("puzzle", obj.get("board"))
+            cells = [x for row in obj for x in (row if isinstance(row, list) else [row])]
+            if sorted(cells) == list(range(16)):
+                puzzle = [cells[i : i + 4] for i in range(0, 16, 4)]
+        except (ValueError, TypeError):
+            pass
+        yield key, puzzle
+
+
+def sequential(model, puzzles, token_count):
+    from generation import Generator
+    from pool import solve_puzzle
+
+    generator = Generator(model)
+    for i, puzzle in enumerate(puzzles):
+        yield i, solve_puzzle(generator, puzzle, token_count)
+
+
+def batched(model, puzzles, max_batch, token_count):
+    """
+    Continuous batching with server.SolveServer, driven synchronously: boards join as others finish
+    Decoding is the same as sequential (grammar mask, forced ids, stop at the first invalid move or board), so results
+    match it up to the small float differences of batched forwards.
+    """
+    from server import Session, SolveServer
+    from tools import is_solution
+
+    server = SolveServer(model, max_batch=max_batch, token_count=token_count, constrained=True)
+    boards = enumerate(puzzles)
+    while True:
+        admit = []
+        for i, puzzle in itertools.islice(boards, max_batch - len(server.active)):
+            session = Session(puzzle, server.fsm)
+            session.index = i
+            admit.append(session)
+        if not admit and not server.active:
+            break
+        for s, event in server.step(admit):
+            if event.get("done"):
+                status = event["status"]
+                stop = status in ("solved", "unsolved")
+                yield s.index, {
+                    "solution": event["solution"],
+                    "valid": is_solution(s.puzzle, event["solution"]),
+                    "tokens": event["tokens"] - stop,  # without the stop token, as solve_puzzle counts them
+                    "error": None if status in ("solved", "unsolved", "budget") else status,
+                    "reason": "stop" if stop else status if status == "budget" else "error",
+                    "seconds": event["seconds"],
+                }
+
+
+def resume_ids(path):
+    """ids already in an output file; a line cut short by an interruption is removed"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    return {json.loads(line)["id"] for line in data[:end].splitlines() if line.strip()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solve 15-puzzle boards from a JSONL file (or stdin), one JSONL result line per board")
+    parser.add_argument("input", nargs="?", default="-", help='JSONL boards, {"id": ..., "puzzle": [[...], ...]} or bare boards; - for stdin')
+    parser.add_argument("-o", "--output", default="-", help="JSONL results; - for stdout")
+    parser.add_argument("--model", default="rwkv_15puzzle_20241214.pth")
+    parser.add_argument("--strategy", default="cpu fp32")
+    parser.add_argument("--workers", type=int, default=0, help="solve in a pool.SolverPool of this many processes")
+    parser.add_argument("--threads", type=int, default=1, help="cores (and torch threads) per pool worker")
+    parser.add_argument("--batch", type=int, default=0, help="without workers: decode this many boards together (continuous batching)")
+    parser.add_argument("--token-count", type=int, default=20000, help="id budget per board")
+    parser.add_argument("--unordered", action="store_true", help="write results as they finish (tagged by id) instead of in input order")
+    parser.add_argument("--resume", action="store_true", help="skip ids already in the output file and append to it")
+    parser.add_argument("--sjf", type=int, default=0, metavar="WINDOW", help="solve each WINDOW boards shortest predicted trace first (puzzle_trace.trace_length)")
+    args = parser.parse_args()
+
+    import puzzle_trace
+
+    if args.resume and args.output == "-":
+        parser.error("--resume needs --output")
+    done = resume_ids(args.output) if args.resume else set()
+    source = sys.stdin if args.input == "-" else open(args.input)
+    out = sys.stdout if args.output == "-" else open(args.output, "a" if args.resume else "w")
+
+    keys = []  # (sequence number, id, puzzle, predicted tokens) of each board handed to the solver
+    waiting = {}  # sequence number -> result line not written yet (ordered output)
+    count = [0, 0]  # boards read, lines written
+
+    def emit(record):
+        out.write(json.dumps(record) + "\n")
+        out.flush()
+        count[1] += 1
+
+    def write(seq, record):
+        if args.unordered:
+            emit(record)
+            return
+        waiting[seq] = record
+        while count[1] in waiting:  # lines written so far = next sequence number due
+            emit(waiting.pop(count[1]))
+
+    def boards():
+        window = []
+        for key, puzzle in read_boards(source):
+            if key in done:
+                continue
+            seq = count[0]
+            count[0] += 1
+            if puzzle is None:
+                write(seq, {"id": key, "puzzle": None, "solution": [], "valid": False, "tokens": 0, "error": "bad puzzle", "reason": "error", "seconds": 0.0})
+                continue
+            window.append((seq, key, puzzle, puzzle_trace.trace_length(puzzle)))
+            if len(window) >= args.sjf:
+                yield from release(window)
+                window = []
+        yield from release(window)
+
+    def release(window):
+        for entry in sorted(window, key=lambda e: e[3]):
+            keys.append(entry)
+            yield entry[2]
+
+    if args.workers > 0:
+        from pool import SolverPool
+
+        pool = SolverPool(args.model, args.strategy, args.workers, args.threads, args.token_count)
+        results = pool.imap(boards())
+    else:
+        os.environ.setdefault("RWKV_JIT_ON", "1")
+        os.environ.setdefault("RWKV_CUDA_ON", "0")
+        from rwkv_model import RWKV
+
+        model = RWKV(model=args.model, strategy=args.strategy, verbose=False)
+        results = batched(model, boards(), args.batch, args.token_count) if args.batch > 0 else sequential(model, boards(), args.token_count)
+
+    try:
+        for i, result in results:
+            seq, key, puzzle, predicted = keys[i]
+            write(seq, {"id": key, "puzzle": puzzle, **result, "predicted_tokens": predicted})
+    finally:
+        if args.workers > 0:
+            pool.close()
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import torch
+
+
+class StateArena:
+    """
+    Preallocated RWKV v6 states for many sessions, addressed by slot
+
+    One tensor per state kind holds every slot: att_xx [L, S, C], att_kv [L, S, H, N, N] (float32), ffn_xx [L, S, C],
+    and the previous token ids [S] when the model uses the layer 0 pair table. A session keeps its slot for its whole
+    life and sessions coming and going do not allocate or free state storage.
+    Single-token steps run RWKV.forward_batch(inplace=True) on views of the arena: the WKV state is updated with
+    s.mul_(w).add_(a) and xx / prev are copied into the slots, so no new state tensors are made per token. Scattered
+    slots are gathered into one batch and scattered back after the step; a run of consecutive slots is not copied at
+    all. Prompts (several tokens) go through RWKV.forward and are copied back into the slot.
+    """
+
+    def __init__(self, model, slots):
+        if model.version != 6.0 or len(set((str(dd.device), dd.atype) for dd in model.strategy)) > 1:
+            raise NotImplementedError("StateArena needs a v6 model on a single device and dtype")
+        self.model = model
+        self.slots = slots
+        args = model.args
+        L = args.n_layer
+        init = model.zero_state_batch(1)  # initial state, with time_state if the model has one
+        self.init = init
+        self.att_xx = torch.empty((L, slots, *init[0].shape[1:]), dtype=init[0].dtype, device=init[0].device)
+        self.att_kv = torch.empty((L, slots, *init[1].shape[1:]), dtype=init[1].dtype, device=init[1].device)
+        self.ffn_xx = torch.empty((L, slots, *init[2].shape[1:]), dtype=init[2].dtype, device=init[2].device)
+        self.prev = torch.empty((slots,), dtype=torch.long) if model.tracks_prev(init) else None
+        self.free = list(range(slots - 1, -1, -1))  # acquire pops the lowest slot first
+        self.used = set()
+
+    def views(self, index):
+        # state in RWKV.forward layout, as views of the arena: index is a slot (one state) or a slice (batched state)
+        state = []
+        for i in range(self.model.args.n_layer):
+            state += [self.att_xx[i, index], self.att_kv[i, index], self.ffn_xx[i, index]]
+        if self.prev is not None:
+            state.append(self.prev[index])
+        return state
+
+    # ---------------------------------------------------------------- slots
+
+    def acquire(self, state=None):
+        """
+        Args:
+            state: optional state to start from (as returned by RWKV.forward), copied in; default the initial state
+        Returns:
+            Slot index
+        """
+        if not self.free:
+            raise RuntimeError(f"StateArena is full ({self.slots} slots)")
+        slot = self.free.pop()
+        self.used.add(slot)
+        self.put(slot, state)
+        return slot
+
+    def release(self, slot):
+        self.used.remove(slot)
+        self.free.append(slot)
+
+    def clone(self, slot):
+        """New slot holding a copy of slot's state"""
+        new = self.acquire()
+        for dst, src in zip(self.views(new), self.views(slot)):
+            dst.copy_(src)
+        return new
+
+    def put(self, slot, state=None):
+        """Copy a state (or the initial state) into slot"""
+        if state is None:
+            state = [s[0] for s in self.init]
+        for dst, src in zip(self.views(slot), state):
+            dst.copy_(src)
+
+    def get(self, slot):
+        """Copy of slot's state, usable with RWKV.forward"""
+        return [s.clone() for s in self.views(slot)]
+
+    # ---------------------------------------------------------------- forward
+
+    @staticmethod
+    def write_back(views, state):
+        for dst, src in zip(views, state):
+            if src is not dst:
+                dst.copy_(src)
+
+    def forward(self, tokens, slot, full_output=False):
+        """RWKV.forward on slot's state, the new state is copied back into the slot; returns the logits"""
+        if len(tokens) == 1 and not full_output:
+            return self.forward_batch(tokens, [slot])[0]
+        views = self.views(slot)
+        out, state = self.model.forward(tokens, list(views), full_output=full_output)
+        self.write_back(views, state)
+        return out
+
+    def forward_batch(self, tokens, slots):
+        """
+        RWKV.forward_batch over several slots, updating their states in place
+        Args:
+            tokens: one id per slot
+            slots: slot indices; a run of consecutive slots is used without gathering
+        Returns:
+            Logits [B, V]
+        """
+        slots = list(slots)
+        if slots == list(range(slots[0], slots[0] + len(slots))):
+            out, _ = self.model.forward_batch(tokens, self.views(slice(slots[0], slots[0] + len(slots))), inplace=True)
+            return out
+
+        index = torch.tensor(slots, dtype=torch.long, device=self.att_kv.device)
+        L = self.model.args.n_layer
+        state = []
+        for i in range(L):
+            state += [self.att_xx[i].index_select(0, index), self.att_kv[i].index_select(0, index), self.ffn_xx[i].index_select(0, index)]
+        if self.prev is not None:
+            state.append(self.prev.index_select(0, index.cpu()))
+        out, state = self.model.forward_batch(tokens, state, inplace=True)
+        for i in range(L):
+            self.att_xx[i].index_copy_(0, index, state[i * 3])
+            self.att_kv[i].index_copy_(0, index, state[i * 3 + 1])
+            self.ffn_xx[i].index_copy_(0, index, state[i * 3 + 2])
+        if self.prev is not None:
+            self.prev.index_copy_(0, index.cpu(), state[-1])
+        return out
+
+    def stats(self):
+        nbytes = sum(t.nbytes for t in (self.att_xx, self.att_kv, self.ffn_xx, self.prev) if t is not None)
+        return {"slots": self.slots, "used": len(self.used), "bytes": nbytes}
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+
+import puzzle_trace
+from puzzle_trace import BOARD_START, INPUT_START
+
+
+class StateCache:
+    """
+    Cache of model states after the prompt, layered on RWKV.forward
+
+    The constant prefix "<input>\\n<board>\\n" is run once; the state after the whole input is kept per board
+    (16 cells) in an LRU bounded by max_bytes. Returned states are copies, forward may update them in place.
+    """
+
+    PREFIX = [INPUT_START, BOARD_START]
+
+    def __init__(self, model, max_bytes=64 * 2**20):
+        self.model = model
+        self.tokenizer = puzzle_trace.get_tokenizer()
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # board -> (out, state, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefix = None
+
+    @staticmethod
+    def key(puzzle):
+        return tuple(n for row in puzzle for n in row)
+
+    @staticmethod
+    def copy(out, state):
+        return out.clone(), [s.clone() for s in state]
+
+    def prompt(self, puzzle):
+        return self.tokenizer.encode(puzzle_trace.format_input(puzzle))
+
+    def prefill(self, puzzle):
+        """
+        Args:
+            puzzle: 4x4 list of numbers
+        Returns:
+            (out, state) after puzzle_trace.format_input(puzzle), as model.forward would return them
+        """
+        key = self.key(puzzle)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.copy(entry[0], entry[1])
+        self.misses += 1
+
+        if self.prefix is None:
+            self.prefix = self.model.forward(self.PREFIX, None)
+        tokens = self.prompt(puzzle)
+        assert tokens[: len(self.PREFIX)] == self.PREFIX
+        out, state = self.model.forward(tokens[len(self.PREFIX) :], self.copy(*self.prefix)[1])
+
+        nbytes = out.nbytes + sum(s.nbytes for s in state)
+        if nbytes <= self.max_bytes:
+            self.entries[key] = (*self.copy(out, state), nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, _, n) = self.entries.popitem(last=False)
+                self.nbytes -= n
+        return out, state
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.nbytes, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,80 @@
+import os
+
+os.environ.setdefault("RWKV_JIT_ON", "1")
+os.environ.setdefault("RWKV_CUDA_ON", "0")
+
+import pytest
+import torch
+
+from rwkv_model import RWKV
+
+C, L, V, H, F = 64, 2, 83, 2, 128
+
+
+def checkpoint(version):
+    # small random checkpoint with the keys RWKV uses to detect the version
+    torch.manual_seed(0)
+    w = {"emb.weight": torch.randn(V, C) * 0.5, "blocks.0.ln0.weight": torch.ones(C), "blocks.0.ln0.bias": torch.zeros(C)}
+    for i in range(L):
+        p = f"blocks.{i}."
+        for ln in ["ln1", "ln2"]:
+            w[p + ln + ".weight"] = torch.ones(C) + 0.1 * torch.randn(C)
+            w[p + ln + ".bias"] = 0.1 * torch.randn(C)
+        a = p + "att."
+        names = ["receptance", "key", "value", "output"]
+        if version == 4:
+            for n in "kvr":
+                w[a + "time_mix_" + n] = torch.rand(1, 1, C)
+            w[a + "time_decay"] = torch.randn(C) * 0.5 - 1
+            w[a + "time_first"] = torch.randn(C) * 0.3
+        elif version == 5.2:
+            for n in "kvrg":
+                w[a + "time_mix_" + n] = torch.rand(1, 1, C)
+            w[a + "time_decay"] = torch.randn(H, C // H) * 0.5 - 1
+            w[a + "time_faaaa"] = torch.randn(H, C // H) * 0.3
+        else:
+            for n in "xwkvrg":
+                w[a + "time_maa_" + n] = torch.rand(1, 1, C)
+            w[a + "time_maa_w1"] = torch.randn(C, 5 * 8) * 0.05
+            w[a + "time_maa_w2"] = torch.randn(5, 8, C) * 0.05
+            w[a + "time_decay"] = torch.randn(1, 1, C) * 0.5 - 1
+            w[a + "time_decay_w1"] = torch.randn(C, 16) * 0.05
+            w[a + "time_decay_w2"] = torch.randn(16, C) * 0.05
+            w[a + "time_faaaa"] = torch.randn(H, C // H) * 0.3
+        if version != 4:
+            names.append("gate")
+            w[a + "ln_x.weight"] = torch.ones(C)
+            w[a + "ln_x.bias"] = torch.zeros(C)
+        for n in names:
+            w[a + n + ".weight"] = torch.randn(C, C) / C**0.5
+        f = p + "ffn."
+        mix = "time_maa_" if version == 6.0 else "time_mix_"
+        w[f + mix + "k"] = torch.rand(1, 1, C)
+        w[f + mix + "r"] = torch.rand(1, 1, C)
+        w[f + "key.weight"] = torch.randn(F, C) / C**0.5
+        w[f + "receptance.weight"] = torch.randn(C, C) / C**0.5
+        w[f + "value.weight"] = torch.randn(C, F) / F**0.5
+    w["ln_out.weight"] = torch.ones(C)
+    w["ln_out.bias"] = torch.zeros(C)
+    w["head.weight"] = torch.randn(V, C) / C**0.5
+    return w
+
+
+@pytest.fixture(scope="session")
+def models(tmp_path_factory):
+    path = tmp_path_factory.mktemp("models")
+    out = {}
+    for version in [4, 5.2, 6.0]:
+        name = str(path / f"v{version}.pth")
+        torch.save(checkpoint(version), name)
+        out[version] = RWKV(model=name, strategy="cpu fp32", verbose=False, snapshot=False)
+    saved = os.environ.get("RWKV_L0_TABLE")
+    os.environ["RWKV_L0_TABLE"] = "1"
+    try:
+        out["6.0 table"] = RWKV(model=name, strategy="cpu fp32", verbose=False, snapshot=False)
+    finally:
+        if saved is None:
+            del os.environ["RWKV_L0_TABLE"]
+        else:
+            os.environ["RWKV_L0_TABLE"] = saved
+    return out
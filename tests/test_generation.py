@@ -0,0 +1,82 @@
+import pytest
+import torch
+
+import puzzle_trace
+from generation import Generator
+from tools import generate_15_puzzle
+
+PUZZLES = [generate_15_puzzle(i) for i in range(3)]
+
+
+class TraceModel:
+    """
+    The synthetic v6 model pushed onto trace (prompt and solver trace) up to position stop, so a speculative draft is
+    accepted for a while and then rejected; the position is carried as an extra state tensor
+    """
+
+    def __init__(self, model, trace, stop):
+        self.model = model
+        self.trace = trace[:stop]
+
+    def forward(self, tokens, state, full_output=False):
+        pos = 0 if state is None else int(state[-1])
+        out, inner = self.model.forward(tokens, None if state is None else state[:-1], full_output=True)
+        out = out.view(len(tokens), -1).clone()
+        for i in range(len(tokens)):
+            if pos + i + 1 < len(self.trace):
+                out[i, self.trace[pos + i + 1]] += 100
+        return (out if full_output else out[-1]), inner + [torch.tensor(pos + len(tokens))]
+
+
+@pytest.mark.parametrize("puzzle", PUZZLES)
+def test_speculative_is_greedy(models, puzzle):
+    # with the grammar and the board fast-forward off, speculation only saves forward calls: the ids are the greedy ones
+    prompt = puzzle_trace.get_tokenizer().encode(puzzle_trace.format_input(puzzle))
+    trace = prompt + puzzle_trace.draft_tokens(prompt, puzzle)
+    generator = Generator(TraceModel(models[6.0], trace, len(prompt) + 150), draft_len=32)
+    greedy = generator.generate_ids(prompt, puzzle, token_count=300, speculative=False, constrained=False, fast_forward=False)
+    calls = generator.stats["forward_calls"]
+    speculative = generator.generate_ids(prompt, puzzle, token_count=300, constrained=False, fast_forward=False)
+    assert speculative == greedy
+    assert speculative[:150] == trace[len(prompt) : len(prompt) + 150]
+    assert generator.stats["draft_accepted"] >= 150 and generator.stats["draft_rejected"] > 0
+    assert generator.stats["forward_calls"] < calls
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_grammar_accepts_solver_traces(seed):
+    import grammar
+
+    fsm = grammar.get_grammar()
+    puzzle = generate_15_puzzle(seed)
+    trace = puzzle_trace.draft_tokens(puzzle_trace.get_tokenizer().encode(puzzle_trace.format_input(puzzle)), puzzle)
+    states = fsm.walk(fsm.start, trace)
+    assert states is not None and states[-1] in fsm.accept
+    # the mask lets every trace id through, and a forced id is the one the solver writes
+    for state, token in zip([fsm.start] + states, trace):
+        assert fsm.mask[state, token] == 0
+        assert fsm.forced[state] in (-1, token)
+    assert fsm.step(fsm.start, trace[:1] + trace) is None
+    assert fsm.step(fsm.start, trace[:5] + [puzzle_trace.OUTPUT_END]) is None
+
+
+@pytest.mark.parametrize("key", [6.0, "6.0 table"])
+def test_state_cache_hit_is_fresh_prefill(models, key):
+    from state_cache import StateCache
+
+    model = models[key]
+    cache = StateCache(model)
+    for puzzle in PUZZLES:
+        out, state = model.forward(cache.prompt(puzzle), None)
+        for _ in range(2):  # a miss (prefix state plus the board), then a hit
+            cached_out, cached_state = cache.prefill(puzzle)
+            assert torch.allclose(cached_out, out, atol=1e-5)
+            assert all(torch.allclose(a, b, atol=1e-5) for a, b in zip(cached_state, state))
+            for s in cached_state:  # the caller owns the copy, the next hit is not affected
+                s.zero_()
+    assert cache.stats()["hits"] == len(PUZZLES) and cache.stats()["misses"] == len(PUZZLES)
+
+    small = StateCache(model, max_bytes=cache.nbytes // len(PUZZLES))
+    for puzzle in PUZZLES:
+        small.prefill(puzzle)
+    assert list(small.entries) == [StateCache.key(PUZZLES[-1])]  # least recently used boards evicted
@@ -0,0 +1,93 @@
+import pytest
+import torch
+
+from conftest import L, V, checkpoint
+from rwkv_model import RWKV
+
+
+TOKENS = [int(t) for t in torch.randint(0, V, (24,), generator=torch.Generator().manual_seed(1))]
+
+
+@pytest.mark.parametrize("key,size", [(4, 5 * L), (5.2, 3 * L), (6.0, 3 * L), ("6.0 table", 3 * L + 1)])
+def test_one_token_steps_match_sequence(models, key, size):
+    # the state kept across single-token calls must be the model's own state, nothing overwritten or appended
+    model = models[key]
+    seq, _ = model.forward(TOKENS, None)
+    state = None
+    for t in TOKENS:
+        out, state = model.forward([t], state)
+        assert len(state) == size
+    assert torch.allclose(out, seq, atol=1e-4)
+    shapes = [s.shape for s in model.forward(TOKENS[:2], None)[1]]
+    assert [s.shape for s in state] == shapes
+
+
+@pytest.mark.parametrize("chunk_len", [1, 5, 8, 32])
+def test_chunked_wkv_matches_token_loop(models, chunk_len):
+    # chunkwise WKV (padded when chunk_len does not divide the prompt) against the per-token recurrence
+    model = models[6.0]
+    _, start = model.forward(TOKENS[:3], None, chunk_len=0)
+    out, state = model.forward(TOKENS, [s.clone() for s in start], full_output=True, chunk_len=0)
+    out_chunked, state_chunked = model.forward(TOKENS, [s.clone() for s in start], full_output=True, chunk_len=chunk_len)
+    assert torch.allclose(out_chunked, out, atol=1e-4)
+    for a, b in zip(state_chunked, state):
+        assert torch.allclose(a, b, atol=1e-4)
+
+
+def test_pair_table_state(models):
+    model = models["6.0 table"]
+    assert model.l0_table is not None and models[6.0].l0_table is None
+    assert model.tracks_prev(model.forward([1], None)[1])
+    for key in [4, 5.2, 6.0]:
+        assert not models[key].tracks_prev(models[key].forward([1], None)[1])
+
+
+def test_pair_table_same_logits(models):
+    out, state = models[6.0].forward(TOKENS[:1], None)
+    out_table, state_table = models["6.0 table"].forward(TOKENS[:1], None)
+    for t in TOKENS[1:]:
+        out, state = models[6.0].forward([t], state)
+        out_table, state_table = models["6.0 table"].forward([t], state_table)
+        assert torch.allclose(out, out_table, atol=1e-4)
+
+
+def test_kvrg_weights_are_views_of_the_stack(models):
+    # with RWKV_JIT_ON=1 the model is a ScriptModule: the separate k/v/r/g weights must still share the stacked storage
+    model = models[6.0]
+    for i in range(L):
+        kvrg = model.derived.tensors[f"blocks.{i}.att.kvrg.weight"]
+        for j, name in enumerate(["key", "value", "receptance", "gate"]):
+            weight = model.w[f"blocks.{i}.att.{name}.weight"]
+            assert weight.untyped_storage().data_ptr() == kvrg.untyped_storage().data_ptr()
+            assert torch.equal(weight, kvrg[j])
+
+
+def test_snapshot_keeps_derived_tensors(tmp_path):
+    # the snapshot carries the stacked k/v/r/g, so a process mapping it does not rebuild them privately
+    name = str(tmp_path / "v6.pth")
+    torch.save(checkpoint(6.0), name)
+    first = RWKV(model=name, strategy="cpu fp32", verbose=False)
+    out, _ = first.forward(TOKENS, None)
+    model = RWKV(model=name, strategy="cpu fp32", verbose=False)
+    assert model.derived.saved is not None and "blocks.0.att.kvrg.weight" in model.derived.saved
+    kvrg = model.derived.tensors["blocks.0.att.kvrg.weight"]
+    assert model.w["blocks.0.att.key.weight"].untyped_storage().data_ptr() == kvrg.untyped_storage().data_ptr()
+    assert torch.allclose(model.forward(TOKENS, None)[0], out, atol=1e-5)
+
+
+@pytest.mark.parametrize("key", [6.0, "6.0 table"])
+def test_arena_in_place_matches_forward(models, key):
+    # the arena steps its slots in place (consecutive, scattered and single) and must end where RWKV.forward does
+    from state_arena import StateArena
+
+    model = models[key]
+    arena = StateArena(model, 4)
+    slots = [arena.acquire() for _ in range(4)]
+    state = None
+    for t in TOKENS[:8]:
+        out, state = model.forward([t], state)
+        assert torch.allclose(arena.forward_batch([t, t], [slots[0], slots[2]]), out.expand(2, -1), atol=1e-5)
+        assert torch.allclose(arena.forward_batch([t], [slots[3]]), out[None], atol=1e-5)
+        assert torch.allclose(arena.forward([t], slots[1]), out, atol=1e-5)
+    for slot in slots:
+        assert all(torch.allclose(a.to(b.dtype), b, atol=1e-5) for a, b in zip(arena.get(slot), state))
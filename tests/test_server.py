@@ -0,0 +1,31 @@
+import pytest
+
+from server import parse_solve
+
+PUZZLE = [[11, 12, 7, 13], [6, 0, 8, 3], [9, 4, 10, 2], [5, 14, 15, 1]]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {},
+        [],
+        {"puzzle": 5},
+        {"puzzle": [[None] * 4] * 4},
+        {"puzzle": [[2, 1, 3, 4], [5, 6, 7, 8], [9, 10, 11, 12], [13, 14, 15, 0]]},  # odd permutation
+        {"puzzle": PUZZLE, "max_tokens": "100"},
+        {"puzzle": PUZZLE, "max_tokens": 0},
+        {"puzzle": PUZZLE, "deadline_s": [1]},
+        {"puzzle": PUZZLE, "deadline_s": float("nan")},
+    ],
+)
+def test_bad_solve_body(body):
+    # every malformed body is a ValueError, which the handler turns into a 400
+    with pytest.raises(ValueError):
+        parse_solve(body)
+
+
+def test_solve_body():
+    flat = [n for row in PUZZLE for n in row]
+    assert parse_solve({"puzzle": flat, "max_tokens": 10, "deadline_s": 0}) == (PUZZLE, 10, 0)
+    assert parse_solve({"puzzle": PUZZLE}) == (PUZZLE, None, None)